@@ -0,0 +1,421 @@
+#!/usr/bin/python3 -u
+"""
+Description: Event index for the clock module and calendar widget. Events are
+parsed once into per-month buckets and cached until the events file changes.
+Supported dates are M/D (every year), M/D-M/D (range every year), */D (every
+month), weekday names (every week), YYYY-MM-DD and YYYY-MM-DD/YYYY-MM-DD.
+Events can also be imported from ICS files, which are read one line at a time.
+Recurring ICS events are only expanded for the months that are looked up.
+Author: thnikk
+"""
+from datetime import date, datetime, timedelta, timezone
+import calendar
+import hashlib
+import json
+import sys
+import os
+import re
+
+cache_dir = os.path.expanduser('~/.cache/calendar-events')
+# Cached indexes from other versions are parsed again
+index_version = 2
+ics_days = ["MO", "TU", "WE", "TH", "FR", "SA", "SU"]
+# Rule parts that can be expanded for each frequency
+rule_parts = {
+    'DAILY': {'BYDAY'},
+    'WEEKLY': {'BYDAY'},
+    'MONTHLY': {'BYDAY', 'BYMONTHDAY'},
+    'YEARLY': {'BYMONTH', 'BYDAY', 'BYMONTHDAY'},
+}
+
+
+def date_range(start, end) -> list:
+    """ Get list of dates from start to end """
+    return [
+        start + timedelta(days=offset)
+        for offset in range((end - start).days + 1)
+    ]
+
+
+def weekday(name):
+    """ Get weekday number from name or abbreviation """
+    for number, day_name in enumerate(calendar.day_name):
+        if len(name) >= 2 and day_name.lower().startswith(name.lower()):
+            return number
+    return None
+
+
+def add_event(index, key, event) -> None:
+    """ Add event to index buckets for date key """
+    match = re.fullmatch(
+        r'(\d{4})-(\d{1,2})-(\d{1,2})(?:/(\d{4})-(\d{1,2})-(\d{1,2}))?', key)
+    if match:
+        start = date(*map(int, match.groups()[:3]))
+        end = date(*map(int, match.groups()[3:])) if match[4] else start
+        for day in date_range(start, end):
+            index['dated'].setdefault(
+                f"{day.year}-{day.month}", []).append([day.day, event])
+        return
+
+    match = re.fullmatch(r'\*/(\d{1,2})', key)
+    if match:
+        index['monthly'].append([int(match[1]), event])
+        return
+
+    match = re.fullmatch(r'(\d{1,2})/(\d{1,2})(?:-(\d{1,2})/(\d{1,2}))?', key)
+    if match:
+        # Use a leap year so February 29th can be expanded
+        start = date(2000, int(match[1]), int(match[2]))
+        end = date(2000, int(match[3]), int(match[4])) if match[3] else start
+        # Ranges that end before they start wrap into the next year
+        if end < start:
+            end = end.replace(year=2001)
+        for day in date_range(start, end):
+            index['yearly'].setdefault(
+                str(day.month), []).append([day.day, event])
+        return
+
+    if weekday(key) is not None:
+        index['weekly'].append([weekday(key), event])
+        return
+
+    print(f"Skipping event with invalid date: {key}", file=sys.stderr)
+
+
+def new_index() -> dict:
+    """ Get empty index """
+    return {
+        "yearly": {}, "monthly": [], "weekly": [], "dated": {},
+        "recurring": []
+    }
+
+
+def parse_dict(events) -> dict:
+    """ Parse events dictionary into index """
+    index = new_index()
+    for key, value in events.items():
+        for event in value if isinstance(value, list) else [value]:
+            try:
+                add_event(index, key.strip(), event)
+            except ValueError:
+                print(
+                    f"Skipping event with invalid date: {key}",
+                    file=sys.stderr)
+    return index
+
+
+def parse(file) -> dict:
+    """ Parse events file into index """
+    return parse_dict(json.loads(file.read()))
+
+
+def ics_date(value, params):
+    """ Get date from ICS date or date-time value """
+    if 'VALUE=DATE' in params or len(value) == 8:
+        return datetime.strptime(value[:8], '%Y%m%d').date(), True
+    if value.endswith('Z'):
+        return datetime.strptime(value, '%Y%m%dT%H%M%SZ').replace(
+            tzinfo=timezone.utc).astimezone(), False
+    return datetime.strptime(value[:15], '%Y%m%dT%H%M%S'), False
+
+
+def ics_text(value) -> str:
+    """ Unescape ICS text """
+    return re.sub(
+        r'\\([\\,;nN])',
+        lambda match: '\n' if match[1] in 'nN' else match[1], value)
+
+
+def ics_lines(file):
+    """ Get unfolded lines from ICS file """
+    line = None
+    for raw in file:
+        raw = raw.rstrip('\r\n')
+        if raw[:1] in (' ', '\t') and line is not None:
+            line += raw[1:]
+            continue
+        if line is not None:
+            yield line
+        line = raw
+    if line is not None:
+        yield line
+
+
+def add_ics_event(index, event) -> None:
+    """ Add parsed VEVENT to index """
+    if 'DTSTART' not in event or event.get('STATUS') == 'CANCELLED':
+        return
+    start, all_day = ics_date(*event['DTSTART'])
+    length = 1
+    if 'DTEND' in event:
+        end, _ = ics_date(*event['DTEND'])
+        if all_day:
+            length = (end - start).days
+        else:
+            # Events ending at midnight don't show on the next day
+            length = (end.date() - start.date()).days + int(
+                end.time() != datetime.min.time())
+        start = start if all_day else start.date()
+    elif not all_day:
+        start = start.date()
+    length = max(length, 1)
+    summary = ics_text(event.get('SUMMARY', ('', ''))[0])
+
+    if 'RRULE' in event:
+        rule = dict(
+            part.split('=', 1) for part in event['RRULE'][0].split(';')
+            if '=' in part)
+        check_rule(rule)
+        index['recurring'].append([
+            start.isoformat(), length, summary, rule,
+            [
+                ics_date(value, params)[0].isoformat()[:10]
+                for params, values in event.get('EXDATE', [])
+                for value in values.split(',')
+            ]
+        ])
+        return
+
+    for day in date_range(start, start + timedelta(days=length - 1)):
+        index['dated'].setdefault(
+            f"{day.year}-{day.month}", []).append([day.day, summary])
+
+
+def check_rule(rule) -> None:
+    """ Raise ValueError for recurrence rules that can't be expanded """
+    freq = rule.get('FREQ')
+    if freq not in rule_parts:
+        raise ValueError(f"Unsupported frequency: {freq}")
+    unsupported = set(rule) - rule_parts[freq] - {
+        'FREQ', 'INTERVAL', 'COUNT', 'UNTIL', 'WKST'}
+    if unsupported:
+        raise ValueError(f"Unsupported rule parts: {', '.join(unsupported)}")
+    bydays = rule.get('BYDAY', '').split(',') if 'BYDAY' in rule else []
+    # Weekdays like 2MO only make sense within a month
+    if freq in ('DAILY', 'WEEKLY') and any(len(day) > 2 for day in bydays):
+        raise ValueError(f"Unsupported BYDAY for {freq}: {rule['BYDAY']}")
+    # Weekdays within a year like 20MO aren't supported
+    if freq == 'YEARLY' and bydays and 'BYMONTH' not in rule:
+        raise ValueError("Unsupported BYDAY without BYMONTH")
+
+
+def parse_ics(file) -> dict:
+    """ Parse ICS file into index """
+    index = new_index()
+    event = None
+    # Recurring events by UID and dates of their overridden occurrences
+    masters = {}
+    overridden = {}
+    for line in ics_lines(file):
+        if line == 'BEGIN:VEVENT':
+            event = {}
+            continue
+        if line == 'END:VEVENT':
+            try:
+                uid = event.get('UID', ('', ''))[0]
+                if 'RECURRENCE-ID' in event:
+                    overridden.setdefault(uid, []).append(
+                        ics_date(*event['RECURRENCE-ID'])[0].isoformat()[:10])
+                recurring = len(index['recurring'])
+                add_ics_event(index, event)
+                if len(index['recurring']) > recurring:
+                    masters[uid] = index['recurring'][-1]
+            except (ValueError, KeyError) as error:
+                print(
+                    f"Skipping ICS event: {event.get('SUMMARY', [''])[0]} "
+                    f"({error})", file=sys.stderr)
+            event = None
+            continue
+        if event is None or ':' not in line:
+            continue
+        name, value = line.split(':', 1)
+        name, _, params = name.partition(';')
+        if name.upper() == 'EXDATE':
+            event.setdefault('EXDATE', []).append((params, value))
+        else:
+            event[name.upper()] = (value, params)
+    # Overrides replace the occurrence of the recurring event they belong to
+    for uid, dates in overridden.items():
+        if uid in masters:
+            masters[uid][4] += dates
+    return index
+
+
+def month_days(year, month, rule, bydays, default) -> list:
+    """ Get dates in month for BYMONTHDAY and BYDAY or the default day """
+    length = calendar.monthrange(year, month)[1]
+    days = [
+        int(day) if int(day) > 0 else length + int(day) + 1
+        for day in rule['BYMONTHDAY'].split(',')
+    ] if 'BYMONTHDAY' in rule else []
+    # Weekdays like 2MO (second monday) or -1FR (last friday)
+    for nth, weekday_number in bydays:
+        matching = [
+            day for day in range(1, length + 1)
+            if calendar.weekday(year, month, day) == weekday_number]
+        position = nth - 1 if nth > 0 else nth
+        if not nth:
+            days += matching
+        elif -len(matching) <= position < len(matching):
+            days.append(matching[position])
+    days = days if 'BYMONTHDAY' in rule or bydays else [default]
+    return [date(year, month, day) for day in days if 0 < day <= length]
+
+
+def period_dates(start, rule, period):
+    """ Get start of period and dates of occurrences in it """
+    freq = rule.get('FREQ')
+    interval = int(rule.get('INTERVAL', 1))
+    bydays = [
+        (int(day[:-2] or 0), ics_days.index(day[-2:]))
+        for day in rule['BYDAY'].split(',')
+    ] if 'BYDAY' in rule else []
+    if freq == 'DAILY':
+        day = start + timedelta(days=period * interval)
+        weekdays = [weekday_number for _, weekday_number in bydays]
+        return day, [day] if not bydays or day.weekday() in weekdays else []
+    if freq == 'WEEKLY':
+        week = start - timedelta(days=start.weekday()) + timedelta(
+            weeks=period * interval)
+        weekdays = [day for _, day in bydays] or [start.weekday()]
+        return week, [week + timedelta(days=day) for day in weekdays]
+    if freq == 'MONTHLY':
+        months = start.month - 1 + period * interval
+        year, month = start.year + months // 12, months % 12 + 1
+        return date(year, month, 1), month_days(
+            year, month, rule, bydays, start.day)
+    if freq == 'YEARLY':
+        year = start.year + period * interval
+        if 'BYMONTH' in rule:
+            months = [int(month) for month in rule['BYMONTH'].split(',')]
+        elif 'BYMONTHDAY' in rule:
+            months = range(1, 13)
+        else:
+            months = [start.month]
+        return date(year, 1, 1), [
+            day for month in months
+            for day in month_days(year, month, rule, bydays, start.day)]
+    raise ValueError(f"Unsupported frequency: {freq}")
+
+
+def occurrences(start, length, rule, first, last):
+    """ Get dates that a recurring event starts on up to the last date """
+    count = int(rule['COUNT']) if 'COUNT' in rule else None
+    until = ics_date(rule['UNTIL'], '')[0] if 'UNTIL' in rule else None
+    if isinstance(until, datetime):
+        until = until.date()
+    period = 0
+    # Skip ahead to the window if earlier occurrences don't need counting
+    step = {'DAILY': 1, 'WEEKLY': 7}.get(rule.get('FREQ'))
+    if count is None and step:
+        step *= int(rule.get('INTERVAL', 1))
+        period = max(0, ((first - start).days - length) // step - 1)
+    seen = 0
+    while True:
+        period_start, dates = period_dates(start, rule, period)
+        if period_start > last:
+            return
+        for day in sorted(dates):
+            if day < start:
+                continue
+            if (until and day > until) or day > last:
+                return
+            seen += 1
+            if count and seen > count:
+                return
+            yield day
+        period += 1
+
+
+class EventIndex:
+    """ Look up events by month or day """
+    def __init__(self, indexes):
+        self.indexes = indexes
+        self.months = {}
+
+    def month(self, year, month) -> dict:
+        """ Get dictionary of events for each day in month """
+        try:
+            return self.months[(year, month)]
+        except KeyError:
+            pass
+        length = calendar.monthrange(year, month)[1]
+        days = {}
+        for index in self.indexes:
+            for day, event in (
+                index['yearly'].get(str(month), []) +
+                index['monthly'] +
+                index['dated'].get(f"{year}-{month}", [])
+            ):
+                if day <= length:
+                    days.setdefault(day, []).append(event)
+            first = calendar.weekday(year, month, 1)
+            for number, event in index['weekly']:
+                for day in range((number - first) % 7 + 1, length + 1, 7):
+                    days.setdefault(day, []).append(event)
+            self.__recurring__(index, year, month, days)
+        self.months[(year, month)] = dict(sorted(days.items()))
+        return self.months[(year, month)]
+
+    def __recurring__(self, index, year, month, days) -> None:
+        """ Expand recurring events that overlap month """
+        first = date(year, month, 1)
+        last = date(year, month, calendar.monthrange(year, month)[1])
+        for start, length, event, rule, exdates in index['recurring']:
+            start = date.fromisoformat(start)
+            try:
+                for occurrence in occurrences(
+                    start, length, rule, first, last
+                ):
+                    if occurrence.isoformat() in exdates:
+                        continue
+                    for offset in range(length):
+                        day = occurrence + timedelta(days=offset)
+                        if first <= day <= last:
+                            days.setdefault(day.day, []).append(event)
+            except (ValueError, KeyError):
+                pass
+
+    def on(self, day) -> list:
+        """ Get events for date """
+        return self.month(day.year, day.month).get(day.day, [])
+
+
+def load_file(path, parser) -> dict:
+    """ Load index for file from cache or parse it if it changed """
+    stat = os.stat(path)
+    stamp = [path, stat.st_mtime_ns, stat.st_size, index_version]
+    cache_file = os.path.join(
+        cache_dir, f"{hashlib.sha1(path.encode()).hexdigest()[:16]}.json")
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as file:
+            cache = json.loads(file.read())
+        if cache['stamp'] == stamp:
+            return cache['index']
+    except (FileNotFoundError, json.decoder.JSONDecodeError, KeyError):
+        pass
+
+    with open(path, 'r', encoding='utf-8') as file:
+        index = parser(file)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as file:
+        file.write(json.dumps({"stamp": stamp, "index": index}))
+    os.replace(tmp, cache_file)
+    return index
+
+
+def load(path, default=None, ics=()) -> EventIndex:
+    """ Load event index for events file and ICS files. Each file is only
+    parsed again when it changes. """
+    indexes = []
+    try:
+        indexes.append(load_file(path, parse))
+    except FileNotFoundError:
+        indexes.append(parse_dict(default or {}))
+    for ics_path in ics:
+        try:
+            indexes.append(load_file(os.path.expanduser(ics_path), parse_ics))
+        except FileNotFoundError:
+            print(f"Calendar not found: {ics_path}", file=sys.stderr)
+    return EventIndex(indexes)
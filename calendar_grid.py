@@ -0,0 +1,72 @@
+#!/usr/bin/python3 -u
+"""
+Description: Month grid model shared by the clock module and calendar widget
+Author: thnikk
+"""
+from datetime import date, timedelta
+import calendar
+
+
+class Day:  # pylint: disable=too-few-public-methods
+    """ Day in month grid """
+    def __init__(self, day, month, today, events):
+        self.date = day
+        self.outside = day.month != month
+        self.today = day == today
+        self.events = events
+
+
+class MonthGrid:
+    """ Weeks of days for a month. Context adds weeks until that many rows
+    contain days from the previous and next months. """
+    def __init__(
+        self, year, month, events=None, firstweekday=0, context=0, today=None
+    ):
+        self.year = year
+        self.month = month
+        self.firstweekday = firstweekday
+        today = today or date.today()
+
+        weeks = calendar.Calendar(firstweekday).monthdatescalendar(
+            year, month)
+        first = date(year, month, 1)
+        last = date(year, month, calendar.monthrange(year, month)[1])
+        while sum(week[0] < first for week in weeks) < context:
+            weeks.insert(0, [day - timedelta(days=7) for day in weeks[0]])
+        while sum(week[-1] > last for week in weeks) < context:
+            weeks.append([day + timedelta(days=7) for day in weeks[-1]])
+
+        self.weeks = [
+            [
+                Day(day, month, today, events.on(day) if events else [])
+                for day in week
+            ] for week in weeks
+        ]
+
+    def day_names(self) -> list:
+        """ Get two letter day names starting at the first weekday """
+        return [
+            calendar.day_abbr[day][:2] for day in
+            calendar.Calendar(self.firstweekday).iterweekdays()
+        ]
+
+    def text(self, format_day, format_names=None) -> str:
+        """ Get calendar laid out like calendar.month with markup from
+        format_day for each day in the month """
+        names = " ".join(self.day_names())
+        lines = [
+            f"{calendar.month_name[self.month]} {self.year}".center(
+                len(names)).rstrip(),
+            format_names(names) if format_names else names
+        ]
+        for week in self.weeks:
+            cells = []
+            for day in week:
+                if day.outside:
+                    cells.append('  ')
+                    continue
+                number = str(day.date.day)
+                cells.append(
+                    ' ' * (2 - len(number)) + format_day(day, number))
+            lines.append(" ".join(cells).rstrip())
+        return "\n".join(lines)
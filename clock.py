@@ -5,34 +5,26 @@ Events are stored locally in ~/.config/calendar-events.json
 Author: thnikk
 """
 from datetime import datetime
-import calendar
-import re
+from html import escape
+import argparse
 import json
 import time
 import os
+from common import Watcher
+from calendar_grid import MonthGrid
+import calendar_events
 import tooltip as tt
 
 
-def highlight(cal, day, color, bg=None) -> str:
-    """ Highlight day """
-    # Deconstruct
-    days = "\n".join(cal.split('\n')[2:])
-    # Substitute
-    days = re.sub(day, tt.span(day, color, bg=bg), days)
-    # Reconstruct
-    cal = "\n".join(cal.split('\n')[:2] + days.split('\n'))
-    return cal
-
-
-def add_tag(cal, day, tag) -> str:
-    """ Add a tag to a day """
-    # Deconstruct
-    days = "\n".join(cal.split('\n')[2:])
-    # Substitute
-    days = re.sub(day, f'<{tag}>{day}</{tag}>', days)
-    # Reconstruct
-    cal = "\n".join(cal.split('\n')[:2] + days.split('\n'))
-    return cal
+def format_day(day, text) -> str:
+    """ Highlight today and days with events """
+    if day.today and day.events:
+        return tt.span(text, "#2b303b", bg=auto_color(day.events[0]))
+    if day.today:
+        return tt.span(text, "#1c1f26", bg="#d8dee9")
+    if day.events:
+        return tt.span(text, auto_color(day.events[0]))
+    return text
 
 
 def auto_color(event) -> str:
@@ -48,91 +40,101 @@ def event_list(events, now) -> str:
     """ Get list of events as string """
     output = []
     output_dict = {"today": [], "month": []}
-    for date, event in events.items():
-        if str(now.month) == date.split('/')[0]:
-            if str(now.day) == date.split('/')[1]:
-                output_dict['today'].append(event)
-            elif now.day < int(date.split('/')[1]):
-                output_dict['month'].append(f'{date} - {event}')
+    for day, day_events in events.month(now.year, now.month).items():
+        if day == now.day:
+            output_dict['today'] += day_events
+        elif now.day < day:
+            output_dict['month'] += [
+                f'{now.month}/{day} - {event}' for event in day_events]
     if output_dict['today']:
         output.append(tt.heading('Today'))
         for event in output_dict['today']:
-            output.append(tt.span(event, auto_color(event)))
+            output.append(tt.span(escape(event), auto_color(event)))
     if output_dict['month']:
         output.append(tt.heading('Upcoming'))
         for event in output_dict['month']:
-            output.append(tt.span(event, auto_color(event)))
+            output.append(tt.span(escape(event), auto_color(event)))
     return "\n".join(output)
 
 
 def generate_calendar(events) -> str:
     """ Get full calendar as string for tooltip """
     now = datetime.now()
-    day = now.strftime("%d").lstrip('0')
-    cal = calendar.month(
-        int(now.strftime("%y")),
-        int(now.strftime("%m").lstrip('0'))
-    )
-    for date, event in events.items():
-        if str(now.month) == date.split('/')[0]:
-            if str(now.day) == date.split('/')[1]:
-                cal = highlight(cal, date.split('/')[1],
-                                "#2b303b", auto_color(event))
-            else:
-                cal = highlight(cal, date.split('/')[1], auto_color(event))
-    if f'{now.month}/{now.day}' not in list(events):
-        cal = highlight(cal, day, "#1c1f26", "#d8dee9")
-
-    cal = cal.split('\n')
-    cal[1] = tt.span(cal[1], color="#ffffff99")
-    cal = "\n".join(cal).rstrip()
-
+    grid = MonthGrid(now.year, now.month, events, today=now.date())
+    cal = grid.text(
+        format_day, lambda names: tt.span(names, color="#ffffff99"))
     return cal + "\n" + event_list(events, now)
 
 
-def main() -> None:
-    """ Main function """
+def parse_args():
+    """ Parse arguments """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-i', '--ics', action='append', default=[],
+        help='ICS file to import events from (can be used multiple times)')
+    return parser.parse_args()
 
-    # Example events
-    events = {
+
+def load_events(path, ics) -> calendar_events.EventIndex:
+    """ Load events from file or use example events """
+    return calendar_events.load(path, {
         f"{datetime.now().month}/14": "Appointment",
         f"{datetime.now().month}/24": "Birthday",
         f"{datetime.now().month}/25": "Test event"
-    }
+    }, ics)
+
 
+def hidden_date(path):
+    """ Get date that notifications were hidden on """
     try:
-        with open(
-            os.path.expanduser('~/.config/calendar-events.json'),
-            'r', encoding='utf-8'
-        ) as file:
-            events = json.loads(file.read())
+        return datetime.fromtimestamp(os.path.getmtime(path)).date()
     except FileNotFoundError:
-        pass
+        return None
+
 
+def main() -> None:
+    """ Main function """
+    args = parse_args()
+    events_path = os.path.expanduser('~/.config/calendar-events.json')
+    hide_path = os.path.expanduser('~/.cache/hide-calendar-notification')
+    ics = [os.path.expanduser(path) for path in args.ics]
+    watcher = Watcher([events_path, hide_path] + ics)
+    events = load_events(events_path, ics)
+    hidden = hidden_date(hide_path)
+
+    last_output = None
+    tooltip = None
+    tooltip_date = None
     while True:
-        current_time = datetime.now().strftime("%I:%M %m/%d")
+        now = datetime.now()
+        # Only rebuild the calendar when the day changes
+        if now.date() != tooltip_date:
+            tooltip = generate_calendar(events).rstrip()
+            tooltip_date = now.date()
         output = {
-            "text": f" {current_time}",
-            "tooltip": generate_calendar(events).rstrip()
+            "text": f" {now.strftime('%I:%M %m/%d')}",
+            "tooltip": tooltip
         }
 
-        current_date = f'{datetime.now().month}/{datetime.now().day}'
-        if current_date in list(events):
+        today_events = events.on(now.date())
+        if today_events and hidden != now.date():
+            output['text'] += tt.span(' ', auto_color(
+                today_events[0]))
+
+        # Only print when something changed
+        if output != last_output:
+            print(json.dumps(output))
+            last_output = output
+        # Wait until the start of the next minute or until a file changes
+        changed = watcher.wait(60 - time.time() % 60)
+        if changed.intersection([events_path] + ics):
             try:
-                mtime = datetime.fromtimestamp(
-                    os.path.getmtime(
-                        os.path.expanduser(
-                            '~/.cache/hide-calendar-notification')
-                    )
-                )
-                if mtime.date() != datetime.now().date():
-                    raise ValueError
-            except (FileNotFoundError, ValueError):
-                output['text'] += tt.span(' ', auto_color(
-                    events[current_date]))
-
-        print(json.dumps(output))
-        time.sleep(1)
+                events = load_events(events_path, ics)
+                tooltip_date = None
+            except json.decoder.JSONDecodeError:
+                pass
+        if hide_path in changed:
+            hidden = hidden_date(hide_path)
 
 
 if __name__ == "__main__":
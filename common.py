@@ -6,8 +6,14 @@ Author: thnikk
 import os
 import sys
 from datetime import datetime, timedelta
+from contextlib import contextmanager
+import ctypes
+import select
+import struct
 import time
 import inspect
+import tempfile
+import fcntl
 import json
 import requests
 
@@ -48,6 +54,22 @@ def print_debug(msg) -> None:
     print(f'[{timestamp}] [{colored_name}] {msg}', file=sys.stderr)
 
 
+def write_atomic(path, text) -> None:
+    """ Write to temporary file and replace so readers never see a partial
+    file. Each write gets its own temporary file, so threads can save the
+    same file at the same time. """
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.',
+        prefix=f"{os.path.basename(path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            file.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
 def print_bar(waybar_dict) -> None:
     """ Print output to bar """
     print(json.dumps(waybar_dict))
@@ -60,14 +82,30 @@ class Cache:
 
     def save(self, cache):
         """ Save cache to file """
-        with open(self.cache_file, 'w', encoding='utf-8') as file:
-            file.write(json.dumps(cache, indent=4))
+        write_atomic(self.cache_file, json.dumps(cache, indent=4))
 
     def load(self):
         """ Load cache from file """
         with open(self.cache_file, 'r', encoding='utf-8') as file:
             return json.loads(file.read())
 
+    @contextmanager
+    def lock(self):
+        """ Hold exclusive lock for cache while refreshing """
+        with open(f"{self.cache_file}.lock", 'w', encoding='utf-8') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def modified_since(self, timestamp) -> bool:
+        """ Check if cache was written after timestamp """
+        try:
+            return os.path.getmtime(self.cache_file) > timestamp
+        except FileNotFoundError:
+            return False
+
 
 class Cache2:
     """ Cache managment """
@@ -81,11 +119,10 @@ class Cache2:
 
     def save(self, cache):
         """ Save cache to file """
-        with open(self.cache_file, 'w', encoding='utf-8') as file:
-            file.write(json.dumps({
-                "data": cache,
-                "timestamp": datetime.now().timestamp()
-            }, indent=4))
+        write_atomic(self.cache_file, json.dumps({
+            "data": cache,
+            "timestamp": datetime.now().timestamp()
+        }, indent=4))
 
     def load(self):
         """ Load cache from file """
@@ -102,3 +139,78 @@ class Cache2:
             return (datetime.now() - timestamp) > self.max_age
         except (KeyError, TypeError):
             return True
+
+
+class Watcher:
+    """ Watch files for changes with inotify and fall back to polling """
+    # IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE and
+    # IN_DELETE
+    mask = 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+
+    def __init__(self, paths, poll=5):
+        self.paths = [os.path.expanduser(path) for path in paths]
+        self.poll = poll
+        self.stamps = self.get_stamps()
+        self.dirs = {}
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if self.fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            # Watch directories so files that are replaced or deleted and
+            # created again are still seen
+            for directory in {os.path.dirname(path) for path in self.paths}:
+                wd = libc.inotify_add_watch(
+                    self.fd, directory.encode(), self.mask)
+                if wd < 0:
+                    os.close(self.fd)
+                    raise OSError(ctypes.get_errno(), directory)
+                self.dirs[wd] = directory
+        except (OSError, AttributeError) as error:
+            print_debug(f"Polling files because inotify failed: {error}")
+            self.fd = None
+
+    def get_stamps(self) -> dict:
+        """ Get modification times for files """
+        stamps = {}
+        for path in self.paths:
+            try:
+                stamps[path] = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                stamps[path] = None
+        return stamps
+
+    def read(self) -> set:
+        """ Read pending inotify events and get changed paths """
+        changed = set()
+        data = os.read(self.fd, 4096)
+        while data:
+            wd, _, _, length = struct.unpack('iIII', data[:16])
+            name = data[16:16 + length].rstrip(b'\0').decode()
+            path = os.path.join(self.dirs[wd], name)
+            if path in self.paths:
+                changed.add(path)
+            data = data[16 + length:]
+        return changed
+
+    def wait(self, timeout) -> set:
+        """ Wait until a file changes or the timeout passes and get changed
+        paths """
+        deadline = time.monotonic() + timeout
+        remaining = timeout
+        while remaining > 0:
+            if self.fd is None:
+                time.sleep(min(self.poll, remaining))
+                stamps = self.get_stamps()
+                changed = {
+                    path for path in self.paths
+                    if stamps[path] != self.stamps[path]}
+                self.stamps = stamps
+            elif select.select([self.fd], [], [], remaining)[0]:
+                changed = self.read()
+            else:
+                changed = set()
+            if changed:
+                return changed
+            remaining = deadline - time.monotonic()
+        return set()
@@ -0,0 +1,219 @@
+#!/usr/bin/python3 -u
+"""
+Description: Host process that loads modules once and runs each of them on
+its own schedule. Output is streamed to clients over unix sockets so waybar
+doesn't need to start a new interpreter every interval. Modules are defined
+in ~/.config/bar-daemon.json
+Author: thnikk
+"""
+import importlib.util
+import threading
+import argparse
+import signal
+import socket
+import json
+import time
+import sys
+import os
+from common import print_debug
+
+config_file = os.path.expanduser("~/.config/bar-daemon.json")
+socket_dir = os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'bar-daemon')
+script_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+def parse_args():
+    """ Parse arguments """
+    parser = argparse.ArgumentParser(
+        description="Run modules in one process or stream output from it")
+    parser.add_argument(
+        '-c', '--client', type=str,
+        help='Print output for module with this name')
+    parser.add_argument(
+        '--config', type=str, default=config_file, help='Config file')
+    return parser.parse_args()
+
+
+class ThreadOutput:
+    """ Stdout replacement that sends lines printed by a module to its
+    server """
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def write(self, text) -> int:
+        """ Write to server for module threads and stdout otherwise """
+        server = getattr(self.local, 'server', None)
+        if not server:
+            return self.stdout.write(text)
+        self.local.buffer += text
+        *lines, self.local.buffer = self.local.buffer.split('\n')
+        for line in lines:
+            if line:
+                server.publish(line)
+        return len(text)
+
+    def flush(self) -> None:
+        """ Flush stdout """
+        self.stdout.flush()
+
+
+class ThreadArgv:
+    """ Argv replacement so each module parses its own arguments """
+    def __init__(self, argv):
+        self.argv = argv
+        self.local = threading.local()
+
+    def current(self) -> list:
+        """ Get argv for current thread """
+        return getattr(self.local, 'argv', self.argv)
+
+    def __getitem__(self, index):
+        return self.current()[index]
+
+    def __len__(self):
+        return len(self.current())
+
+    def __iter__(self):
+        return iter(self.current())
+
+
+class Server:
+    """ Unix socket that streams the output of a module to clients """
+    def __init__(self, name):
+        self.path = os.path.join(socket_dir, f"{name}.sock")
+        self.clients = []
+        self.last = None
+        self.lock = threading.Lock()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self) -> None:
+        """ Accept clients and send them the last line """
+        while True:
+            client, _ = self.sock.accept()
+            client.settimeout(1)
+            with self.lock:
+                if self.last:
+                    try:
+                        client.sendall(f"{self.last}\n".encode('utf-8'))
+                    except OSError:
+                        client.close()
+                        continue
+                self.clients.append(client)
+
+    def publish(self, line) -> None:
+        """ Send line to all clients if it changed """
+        with self.lock:
+            if line == self.last:
+                return
+            self.last = line
+            for client in list(self.clients):
+                try:
+                    client.sendall(f"{line}\n".encode('utf-8'))
+                except OSError:
+                    client.close()
+                    self.clients.remove(client)
+
+
+class Module:
+    """ Module that is loaded once and run on its own schedule """
+    def __init__(self, name, info):
+        self.name = name
+        self.path = os.path.join(
+            script_dir, os.path.expanduser(info['script']))
+        self.argv = [self.path] + info.get('args', [])
+        self.interval = info.get('interval', 'once')
+        if self.interval == 'once':
+            self.interval = None
+        self.signal = info.get('signal')
+        self.server = Server(name)
+        self.trigger = threading.Event()
+        self.module = None
+
+    def load(self) -> None:
+        """ Import the module from its path """
+        spec = importlib.util.spec_from_file_location(
+            f"bar_{self.name.replace('-', '_')}", self.path)
+        self.module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.module)
+
+    def run(self) -> None:
+        """ Run module on interval or when triggered by a signal """
+        sys.stdout.local.server = self.server
+        sys.stdout.local.buffer = ''
+        sys.argv.local.argv = self.argv
+        while True:
+            try:
+                # Scripts without a main function run when imported
+                if self.module is None or not hasattr(self.module, 'main'):
+                    self.load()
+                if hasattr(self.module, 'main'):
+                    self.module.main()
+            except SystemExit:
+                pass
+            except Exception as error:  # pylint: disable=broad-except
+                print_debug(f"{self.name}: {error!r}")
+            self.trigger.wait(self.interval)
+            self.trigger.clear()
+
+
+def client(name) -> None:
+    """ Print lines from the daemon and reconnect if it restarts """
+    path = os.path.join(socket_dir, f"{name}.sock")
+    while True:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(path)
+                for line in sock.makefile('r', encoding='utf-8'):
+                    print(line, end='')
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+        time.sleep(5)
+
+
+def main():
+    """ Main function """
+    args = parse_args()
+    if args.client:
+        client(args.client)
+        return
+
+    try:
+        with open(args.config, 'r', encoding='utf-8') as file:
+            config = json.loads(file.read())
+    except FileNotFoundError:
+        print_debug(f"Define modules in {args.config}")
+        sys.exit(1)
+
+    os.makedirs(socket_dir, exist_ok=True)
+    sys.stdout = ThreadOutput(sys.stdout)
+    sys.argv = ThreadArgv(sys.argv)
+    modules = [Module(name, info) for name, info in config.items()]
+
+    def trigger(signum, frame):
+        """ Run modules for signal immediately """
+        del frame
+        for module in modules:
+            if module.signal and signal.SIGRTMIN + module.signal == signum:
+                module.trigger.set()
+
+    for signum in {module.signal for module in modules if module.signal}:
+        signal.signal(signal.SIGRTMIN + signum, trigger)
+
+    for module in modules:
+        threading.Thread(target=module.run, daemon=True).start()
+
+    while True:
+        signal.pause()
+
+
+if __name__ == "__main__":
+    main()
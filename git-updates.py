@@ -4,14 +4,14 @@ Description: Track updates from git repo
 Author: thnikk
 """
 import os
-from subprocess import run, check_output, CalledProcessError
+from subprocess import run, check_output, CalledProcessError, TimeoutExpired
+import concurrent.futures
 import argparse
 import json
-import re
-from datetime import datetime, timezone
 import sys
-from common import print_debug
+from common import print_debug, Cache
 import tooltip as tt
+import git_cache
 
 
 class Git:
@@ -19,6 +19,9 @@ class Git:
     def __init__(self, path):
         self.path = path
         self.name = self.get_name()
+        self.git_dir = self.get_git_dir()
+        self.branch = self.default_branch()
+        self.cache = Cache(git_cache.cache_path(path))
 
     def get_name(self) -> str:
         """ Get name of repo """
@@ -28,111 +31,247 @@ class Git:
         ).decode().strip().split('/')[-1].split('.')[0].replace('-', ' ')
         return name.capitalize()
 
-    def fetch(self) -> None:
-        """ Fetch """
+    def get_git_dir(self) -> str:
+        """ Get directory that refs are stored in """
+        git_dir = os.path.join(self.path, '.git')
+        # Worktrees and submodules use a file that points to the git dir
+        if os.path.isfile(git_dir):
+            with open(git_dir, 'r', encoding='utf-8') as file:
+                git_dir = os.path.join(
+                    self.path, file.read().split(':', 1)[1].strip())
         try:
-            run(
-                ['git', '-C', self.path, 'fetch'],
-                check=True, capture_output=True
-            )
-        except CalledProcessError as e:
-            print(e.output)
+            with open(
+                os.path.join(git_dir, 'commondir'), 'r', encoding='utf-8'
+            ) as file:
+                git_dir = os.path.join(git_dir, file.read().strip())
+        except FileNotFoundError:
+            pass
+        return git_dir
 
-    def commits(self):
-        """ Get commits """
+    def ref(self, name):
+        """ Get hash for ref from loose refs or packed-refs """
+        try:
+            with open(
+                os.path.join(self.git_dir, name), 'r', encoding='utf-8'
+            ) as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            pass
+        try:
+            with open(
+                os.path.join(self.git_dir, 'packed-refs'), 'r',
+                encoding='utf-8'
+            ) as file:
+                for line in file:
+                    if line.rstrip('\n').endswith(f' {name}'):
+                        return line.split()[0]
+        except FileNotFoundError:
+            pass
+        return None
 
-        def plural(num) -> str:
-            """ Pluralize word """
-            if num > 1:
-                return 's'
-            return ''
-
-        def get_time(input_list) -> str:
-            """ Get string of x days/minutes/hours ago """
-            for value, word in enumerate(['day', 'hour', 'minute', 'second']):
-                if input_list[value]:
-                    return (
-                        f"{input_list[value]} "
-                        f"{word}{plural(input_list[value])} ago")
+    def default_branch(self) -> str:
+        """ Get default branch from origin/HEAD """
+        origin_head = self.ref('refs/remotes/origin/HEAD')
+        if origin_head and origin_head.startswith('ref:'):
+            return origin_head.split('refs/remotes/origin/', 1)[1]
+        for branch in ['main', 'master']:
+            if self.ref(f'refs/remotes/origin/{branch}'):
+                return branch
+        return 'main'
+
+    def remote_tip(self, timeout=None):
+        """ Get hash of default branch on remote without fetching """
+        try:
+            output = run(
+                ['git', '-C', self.path, 'ls-remote', 'origin',
+                 f'refs/heads/{self.branch}'],
+                check=True, capture_output=True, timeout=timeout
+            ).stdout.decode('utf-8').split()
+        except CalledProcessError as e:
+            print_debug(e.stderr.decode('utf-8').strip())
             return None
+        except TimeoutExpired:
+            print_debug(f"Checking {self.name} timed out.")
+            return None
+        return output[0] if output else None
 
+    def fetch(
+        self, timeout=None, branch_only=False, tags=True, filter_spec=None
+    ) -> None:
+        """ Fetch if the default branch changed on the remote """
+        remote = self.remote_tip(timeout)
+        if remote is None or remote == self.ref(
+            f'refs/remotes/origin/{self.branch}'
+        ):
+            return
+        command = ['git', '-C', self.path, 'fetch']
+        if not tags:
+            command.append('--no-tags')
+        # Servers that don't support filters send everything with a warning.
+        # Git keeps the filter in the remote config, so the repo stays a
+        # partial clone and gets missing files from the remote on checkout.
+        if filter_spec:
+            command.append(f'--filter={filter_spec}')
+        if branch_only:
+            command += [
+                'origin', f'+refs/heads/{self.branch}:'
+                f'refs/remotes/origin/{self.branch}'
+            ]
         try:
-            command_output = run(
-                [
-                    'git', '-C', os.path.expanduser(self.path), 'log',
-                    '--name-only', 'main..origin'
-                ],
-                check=True, capture_output=True
-            ).stdout.decode('utf-8')
-        except CalledProcessError:
+            run(command, check=True, capture_output=True, timeout=timeout)
+        except CalledProcessError as e:
+            print_debug(e.stderr.decode('utf-8').strip())
+        except TimeoutExpired:
+            print_debug(f"Fetching {self.name} timed out.")
+
+    def parse_log(self, hashes) -> dict:
+        """ Get commit records for hashes """
+        command_output = run(
+            [
+                'git', '-C', self.path, 'log', '--stdin', '--no-walk=unsorted',
+                '-z', '--name-only', '--format=%x1e%H%x1f%an%x1f%at%x1f%s'
+            ],
+            input="\n".join(hashes).encode('utf-8'),
+            check=True, capture_output=True
+        ).stdout.decode('utf-8')
+        # Each commit starts with a record separator and has unit separated
+        # fields followed by NUL separated file names.
+        records = {}
+        for record in command_output.split('\x1e')[1:]:
+            header, _, files = record.partition('\0')
+            chash, author, timestamp, msg = header.split('\x1f', 3)
+            records[chash] = {
+                "author": author,
+                "timestamp": int(timestamp),
+                "msg": msg.strip().replace('&', 'and'),
+                "files": [
+                    file for file in files.lstrip('\n').split('\0') if file]
+            }
+        return records
+
+    def commits(self):
+        """ Get commits """
+        try:
+            cache = self.cache.load()
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            cache = {}
+        records = cache.get('records', {})
+        refs = [
+            self.ref(f'refs/heads/{self.branch}'),
+            self.ref(f'refs/remotes/origin/{self.branch}')
+        ]
+        # Only list commits again if one of the branches moved and only
+        # parse the ones that aren't cached yet
+        if cache.get('refs') != refs:
             try:
-                command_output = run(
+                hashes = run(
                     [
-                        'git', '-C', os.path.expanduser(self.path), 'log',
-                        '--name-only', 'master..origin'
+                        'git', '-C', self.path, 'rev-list',
+                        f'{self.branch}..origin/{self.branch}'
                     ],
                     check=True, capture_output=True
-                ).stdout.decode('utf-8')
+                ).stdout.decode('utf-8').split()
+                new = [chash for chash in hashes if chash not in records]
+                if new:
+                    records.update(self.parse_log(new))
             except CalledProcessError as e:
                 lines = e.stderr.decode('utf-8').splitlines()
                 for line in lines:
                     print_debug(line)
-                sys.exit(1)
-        output = {}
-        for line in command_output.splitlines():
-            if re.match('^commit', line):
-                chash = line.split()[1][:7]
-                output[chash] = {
-                    "author": None, "date": None, "msg": None, "files": []}
-            elif re.match('^Author:', line):
-                output[chash]['author'] = \
-                    line.split(":")[1].split("<")[0].strip()
-            elif re.match('^Date:', line):
-                date = ':'.join(line.split(":")[1:]).strip()
-                delta = datetime.now(timezone.utc) - datetime.strptime(
-                    date, '%a %b %d %H:%M:%S %Y %z')
-                dhms = [
-                    delta.days, delta.seconds // 60 // 60,
-                    delta.seconds // 60, delta.seconds]
-                output[chash]['date'] = get_time(dhms)
-            elif re.match('^ ', line):
-                output[chash]['msg'] = line.strip().replace('&', 'and')
-            else:
-                if line:
-                    output[chash]['files'].append(line)
-        return output
+                raise ValueError from e
+            cache = {
+                "name": self.name, "branch": self.branch, "refs": refs,
+                "commits": hashes, "records": {
+                    chash: records[chash] for chash in hashes
+                    if chash in records
+                }
+            }
+            self.cache.save(cache)
+        return git_cache.commits(cache)
 
 
 def parse_args():
     """ Parse arguments """
     parser = argparse.ArgumentParser()
-    parser.add_argument('path', type=str, help='Path to git repo')
+    parser.add_argument(
+        'path', type=str, nargs='+', help='Paths to git repos')
     parser.add_argument('-i', '--icon', type=str, default='')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=4,
+        help='Number of repos to fetch at the same time')
+    parser.add_argument(
+        '-t', '--timeout', type=int, default=60,
+        help='Seconds to wait for each fetch')
+    parser.add_argument(
+        '-b', '--branch-only', action='store_true',
+        help='Only fetch the default branch')
+    parser.add_argument(
+        '-n', '--no-tags', action='store_true', help="Don't fetch tags")
+    parser.add_argument(
+        '-f', '--filter', type=str,
+        help='Partial clone filter for fetching, like blob:none. This turns '
+        'the repo into a partial clone for good, so later checkouts download '
+        'file contents from the remote')
     return parser.parse_args()
 
 
+def check_repo(path, args):
+    """ Fetch repo and get new commits """
+    git = Git(path)
+    git.fetch(args.timeout, args.branch_only, not args.no_tags, args.filter)
+    return git, git.commits()
+
+
 def main():
     """ Main function """
     args = parse_args()
-    git = Git(os.path.expanduser(args.path))
-    git.fetch()
-    commits = git.commits()
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=args.jobs
+    ) as pool:
+        futures = [
+            pool.submit(check_repo, os.path.expanduser(path), args)
+            for path in args.path
+        ]
+    repos = []
+    for future in futures:
+        try:
+            repos.append(future.result())
+        except (ValueError, CalledProcessError):
+            pass
+    if not repos:
+        sys.exit(1)
 
     tooltip = []
-    for commit, info in commits.items():
-        tooltip.append(
-            f"{tt.span(commit, 'blue')} {info['msg']} "
-            f"({tt.span(info['date'], 'green')})"
-        )
-        for file in info['files']:
-            tooltip.append(f'  {file}')
-        tooltip.append('')
-
-    if commits:
+    for git, commits in repos:
+        if not commits:
+            continue
+        # Group commits by repo if there is more than one
+        if len(args.path) > 1:
+            tooltip.append(tt.heading(git.name))
+        for commit, info in commits.items():
+            tooltip.append(
+                f"{tt.span(commit, 'blue')} {info['msg']} "
+                f"({tt.span(info['date'], 'green')})"
+            )
+            for file in info['files']:
+                tooltip.append(f'  {file}')
+            tooltip.append('')
+
+    total = sum(len(commits) for _, commits in repos)
+    if len(args.path) > 1:
+        widget = {"repos": [
+            {"name": git.name, "commits": commits}
+            for git, commits in repos
+        ]}
+    else:
+        git, commits = repos[0]
+        widget = {"name": git.name, "commits": commits}
+
+    if total:
         print(json.dumps({
-            "text": f"{args.icon} {len(commits)}",
+            "text": f"{args.icon} {total}",
             "tooltip": "\n".join(tooltip).strip(),
-            "widget": {"name": git.name, "commits": commits}
+            "widget": widget
         }))
     else:
         print(json.dumps({"text": ""}))
@@ -0,0 +1,55 @@
+#!/usr/bin/python3 -u
+"""
+Description: Commit cache shared by the git module and git widget. Parsed
+commits are stored per repo and keyed by hash, so only new commits are parsed
+and the widget can show them without running git.
+Author: thnikk
+"""
+import hashlib
+import json
+import time
+import os
+
+
+def cache_path(path) -> str:
+    """ Get path of commit cache for repo """
+    return os.path.expanduser(
+        "~/.cache/git-updates-"
+        f"{hashlib.sha1(os.path.realpath(path).encode()).hexdigest()[:16]}"
+        ".json")
+
+
+def plural(num) -> str:
+    """ Pluralize word """
+    if num > 1:
+        return 's'
+    return ''
+
+
+def get_time(timestamp) -> str:
+    """ Get string of x days/minutes/hours ago """
+    delta = int(time.time()) - int(timestamp)
+    for seconds, word in [
+        (86400, 'day'), (3600, 'hour'), (60, 'minute'), (1, 'second')
+    ]:
+        if delta >= seconds:
+            value = delta // seconds
+            return f"{value} {word}{plural(value)} ago"
+    # Commits from less than a second ago or from a clock that's ahead
+    return "just now"
+
+
+def load(path) -> dict:
+    """ Load commit cache for repo """
+    with open(cache_path(path), 'r', encoding='utf-8') as file:
+        return json.loads(file.read())
+
+
+def commits(cache) -> dict:
+    """ Get commits from cache by short hash with the time since each """
+    records = cache.get('records', {})
+    return {
+        chash[:7]: {
+            **records[chash], "date": get_time(records[chash]['timestamp'])
+        } for chash in cache.get('commits', []) if chash in records
+    }
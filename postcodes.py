@@ -0,0 +1,194 @@
+#!/usr/bin/python3 -u
+"""
+Description: Offline postal code index for the weather modules. Import a
+GeoNames postal code file (https://download.geonames.org/export/zip/) once
+and postal codes are looked up with a binary search over a memory-mapped
+file instead of the geocoding API. Several countries can be imported into
+one index, so codes used by more than one country can be looked up with
+their country code.
+Author: thnikk
+"""
+import argparse
+import zipfile
+import struct
+import mmap
+import sys
+import io
+import os
+
+index_file = os.path.expanduser('~/.local/share/postcodes.idx')
+magic = b'PCX1'
+# Magic and number of records
+header = struct.Struct('<4sI')
+# Postal code, country code, latitude, longitude and offset of name and
+# timezone. Records are sorted by postal code and then country code.
+record = struct.Struct('<12s2sffI')
+key_size = 12
+# Open indexes by path
+indexes = {}
+
+
+def normalize(code) -> str:
+    """ Get postal code in the form it's stored in """
+    return " ".join(str(code).split()).upper()
+
+
+class Index:
+    """ Memory-mapped postal code index """
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        file_magic, self.count = header.unpack_from(self.map)
+        if file_magic != magic:
+            raise ValueError(f"{path} isn't a postal code index")
+        self.strings = header.size + self.count * record.size
+
+    def key(self, position) -> bytes:
+        """ Get key of record """
+        offset = header.size + position * record.size
+        return self.map[offset:offset + key_size]
+
+    def lookup(self, code, country=None):
+        """ Get location for postal code or None if it isn't indexed. Without
+        a country, the first country with the postal code is used. """
+        key = normalize(code).encode('utf-8')
+        if len(key) > key_size:
+            return None
+        key = key.ljust(key_size, b'\0')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        for position in range(low, self.count):
+            if self.key(position) != key:
+                return None
+            _, record_country, latitude, longitude, offset = (
+                record.unpack_from(
+                    self.map, header.size + position * record.size))
+            if country is None or (
+                record_country.decode('utf-8') == country.upper()
+            ):
+                break
+        else:
+            return None
+        offset += self.strings
+        length = struct.unpack_from('<H', self.map, offset)[0]
+        name, timezone = self.map[offset + 2:offset + 2 + length].decode(
+            'utf-8').split('\t')
+        return {
+            "latitude": round(latitude, 4), "longitude": round(longitude, 4),
+            "timezone": timezone, "name": name
+        }
+
+
+def lookup(code, country=None, path=index_file):
+    """ Get location for postal code from index or None """
+    try:
+        if path not in indexes:
+            indexes[path] = Index(path)
+    except (FileNotFoundError, ValueError, struct.error):
+        return None
+    return indexes[path].lookup(code, country)
+
+
+def read_dataset(path):
+    """ Get lines from dataset, which can be zipped like the downloads """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            name = next((
+                name for name in archive.namelist()
+                if name.endswith('.txt') and 'readme' not in name.lower()
+            ), None)
+            if name is None:
+                raise ValueError(f"No postal code file in {path}")
+            with archive.open(name) as file:
+                yield from io.TextIOWrapper(file, encoding='utf-8')
+        return
+    with open(path, 'r', encoding='utf-8') as file:
+        yield from file
+
+
+def build(dataset, path=index_file) -> int:
+    """ Build index from GeoNames postal code file. Timezones are read from
+    an extra column if there is one, otherwise Open-Meteo gets them from the
+    coordinates. """
+    entries = {}
+    for line in read_dataset(dataset):
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 11:
+            continue
+        code = normalize(fields[1])
+        key = (code, fields[0].upper())
+        # The first place for each postal code in a country is used
+        if (
+            not code or len(code.encode('utf-8')) > key_size or
+            len(key[1].encode('utf-8')) != 2 or key in entries
+        ):
+            continue
+        try:
+            latitude, longitude = float(fields[9]), float(fields[10])
+        except ValueError:
+            continue
+        timezone = fields[12] if len(fields) > 12 and fields[12] else 'auto'
+        entries[key] = (latitude, longitude, f"{fields[2]}\t{timezone}")
+
+    records = bytearray()
+    strings = bytearray()
+    offsets = {}
+    for key in sorted(
+        entries, key=lambda key: (key[0].encode('utf-8'), key[1])
+    ):
+        latitude, longitude, text = entries[key]
+        if text not in offsets:
+            offsets[text] = len(strings)
+            encoded = text.encode('utf-8')
+            strings += struct.pack('<H', len(encoded)) + encoded
+        records += record.pack(
+            key[0].encode('utf-8'), key[1].encode('utf-8'), latitude,
+            longitude, offsets[text])
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as file:
+        file.write(header.pack(magic, len(entries)))
+        file.write(records)
+        file.write(strings)
+    os.replace(tmp, path)
+    indexes.pop(path, None)
+    return len(entries)
+
+
+def parse_args():
+    """ Parse arguments """
+    parser = argparse.ArgumentParser(
+        description="Import postal codes for the weather modules")
+    parser.add_argument(
+        'dataset', type=str, nargs='?',
+        help="GeoNames postal code file like US.txt or US.zip")
+    parser.add_argument(
+        '-l', '--lookup', type=str, help="Look up postal code in the index")
+    parser.add_argument(
+        '-c', '--country', type=str, help="Country code for the lookup")
+    parser.add_argument(
+        '-o', '--output', type=str, default=index_file, help="Index file")
+    return parser.parse_args()
+
+
+def main():
+    """ Main function """
+    args = parse_args()
+    if args.dataset:
+        try:
+            count = build(args.dataset, args.output)
+        except ValueError as error:
+            sys.exit(f"Couldn't import {args.dataset}: {error}")
+        print(f"Imported {count} postal codes to {args.output}")
+    if args.lookup:
+        print(lookup(args.lookup, args.country, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,37 +3,82 @@
 Description: Privacy module that doesn't crash waybar.
 Author: thnikk
 """
-from subprocess import run, CalledProcessError
+from subprocess import run, Popen, PIPE, CalledProcessError
+from select import select
+import argparse
+import codecs
 import json
 from glob import glob
+import time
 import sys
+import os
+import re
 from common import print_debug
 
+# Characters that change the nesting of pw-dump output
+json_special = re.compile(r'["\\\[\]]')
+
+
+# Process names by pid and start time so reused pids aren't mixed up
+process_names = {}
+
 
 def process_name(pid):
     """ Get process name for PID """
+    with open(f'/proc/{pid}/stat', 'r', encoding='utf-8') as file:
+        stat = file.read()
+    # The start time is the 22nd field, counting from the end of the name
+    start = stat[stat.rindex(')') + 2:].split()[19]
+    try:
+        return process_names[(pid, start)]
+    except KeyError:
+        pass
     with open(f'/proc/{pid}/cmdline', 'r', encoding='utf-8') as file:
-        return file.read().split('\x00')[0].split()[0].split('/')[-1]
+        name = file.read().split('\x00')[0].split()[0].split('/')[-1]
+    process_names[(pid, start)] = name
+    return name
 
 
 def get_webcams():
-    """ Get processes using video devices """
-    webcams = {}
+    """ Get processes using video devices with one pass over /proc """
+    devices = {}
     for device in glob("/dev/video*"):
         try:
-            output = run(
-                ['fuser', device], check=True, capture_output=True
-            ).stdout.decode('utf-8').strip().split()
-            names = []
-            for pid in output:
-                name = process_name(pid)
-                if 'wireplumber' not in name:
-                    names.append(name)
-            if names:
-                webcams[device] = names
-        except CalledProcessError:
+            stat = os.stat(device)
+            devices[(stat.st_dev, stat.st_ino)] = device
+        except FileNotFoundError:
             pass
-    return webcams
+    if not devices:
+        process_names.clear()
+        return {}
+
+    webcams = {}
+    pids = [pid for pid in os.listdir('/proc') if pid.isdigit()]
+    for pid in pids:
+        try:
+            with os.scandir(f'/proc/{pid}/fd') as fds:
+                found = set()
+                for fd in fds:
+                    try:
+                        stat = fd.stat()
+                    except OSError:
+                        continue
+                    if (stat.st_dev, stat.st_ino) in devices:
+                        found.add(devices[(stat.st_dev, stat.st_ino)])
+            if not found:
+                continue
+            name = process_name(pid)
+        except (OSError, IndexError):
+            continue
+        if 'wireplumber' in name:
+            continue
+        for device in sorted(found):
+            webcams.setdefault(device, []).append(name)
+    # Forget processes that exited so the cache doesn't grow forever
+    running = set(pids)
+    for key in [key for key in process_names if key[0] not in running]:
+        del process_names[key]
+    return dict(sorted(webcams.items()))
 
 
 def json_output(command):
@@ -46,15 +91,65 @@ def json_output(command):
         print_debug('Not using pipewire, quitting.')
         sys.exit(1)
 
-    if "]\n[" in command_output:
-        combined = "[\n" + "],\n[".join(command_output.split(']\n[')) + "\n]"
-        output = []
-        for item in json.loads(combined):
-            output += item
-    else:
-        output = command_output
+    return ArrayReader().feed(command_output)
 
-    return output
+
+class ArrayReader:
+    """ Decode concatenated JSON arrays as they arrive. Each chunk is only
+    scanned once for the end of the array, which is decoded when it's
+    complete. """
+    def __init__(self):
+        self.pending = []
+        self.depth = 0
+        self.string = False
+        self.escape = False
+
+    def feed(self, text) -> list:
+        """ Add text and get objects of the arrays it completes """
+        objects = []
+        start = 0
+        # An escape at the end of the last chunk skips the first character
+        skip = int(self.escape)
+        self.escape = False
+        for match in json_special.finditer(text):
+            position, char = match.start(), match[0]
+            if position < skip:
+                continue
+            if self.string:
+                if char == '\\':
+                    skip = position + 2
+                    self.escape = skip > len(text)
+                elif char == '"':
+                    self.string = False
+            elif char == '"':
+                self.string = True
+            elif char == '[':
+                self.depth += 1
+            elif char == ']':
+                self.depth -= 1
+                if self.depth == 0:
+                    self.pending.append(text[start:position + 1])
+                    try:
+                        objects += json.loads(''.join(self.pending))
+                    except json.JSONDecodeError as error:
+                        print_debug(f"Skipping invalid output: {error}")
+                    self.pending = []
+                    start = position + 1
+        if self.depth:
+            self.pending.append(text[start:])
+        return objects
+
+
+def update_nodes(nodes, objects) -> None:
+    """ Update node table with objects from pw-dump """
+    for item in objects:
+        if item.get('info') is None:
+            nodes.pop(item.get('id'), None)
+        elif item.get('type') == 'PipeWire:Interface:Node':
+            if item['id'] in nodes:
+                # Keep info that wasn't included in the update
+                item['info'] = {**nodes[item['id']]['info'], **item['info']}
+            nodes[item['id']] = item
 
 
 def get_prop(full_props, prop_list):
@@ -86,10 +181,8 @@ def get_categories(pw):
                     running[mtype] = []
                 if program not in running[mtype]:
                     running[mtype].append(program)
-        except (KeyError, TypeError):
+        except (KeyError, TypeError, AttributeError):
             pass
-    webcams = get_webcams()
-    running.update(webcams)
     return running
 
 
@@ -105,11 +198,20 @@ def get_icons(categories):
     return ' '.join(icons)
 
 
-def main():
-    """ Main function """
-    pw = json_output(['pw-dump'])
-    categories = get_categories(pw)
+def parse_args():
+    """ Parse arguments """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-m', '--monitor', action='store_true',
+        help='Keep running and print when streams change')
+    parser.add_argument(
+        '-i', '--interval', type=int, default=10,
+        help='Seconds between webcam checks in monitor mode')
+    return parser.parse_args()
+
 
+def print_output(categories) -> None:
+    """ Print output for waybar """
     output = {'class': 'green'}
 
     output['text'] = get_icons(categories)
@@ -125,5 +227,52 @@ def main():
     print(json.dumps(output))
 
 
+def monitor(interval) -> None:
+    """ Follow pw-dump and print when running streams or webcams change """
+    try:
+        process = Popen(
+            ['pw-dump', '--monitor', '--no-colors'], stdout=PIPE)
+    except FileNotFoundError:
+        print_debug('Not using pipewire, quitting.')
+        sys.exit(1)
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    reader = ArrayReader()
+    nodes = {}
+    streams = {}
+    webcams = {}
+    webcam_check = 0
+    last = None
+    while True:
+        if select([process.stdout], [], [], interval)[0]:
+            chunk = os.read(process.stdout.fileno(), 65536)
+            if not chunk:
+                print_debug('pw-dump exited, quitting.')
+                sys.exit(1)
+            objects = reader.feed(utf8.decode(chunk))
+            if not objects:
+                continue
+            update_nodes(nodes, objects)
+            streams = get_categories(nodes.values())
+        if time.monotonic() - webcam_check >= interval:
+            webcams = get_webcams()
+            webcam_check = time.monotonic()
+        categories = {**streams, **webcams}
+        if categories != last:
+            print_output(categories)
+            last = categories
+
+
+def main():
+    """ Main function """
+    args = parse_args()
+    if args.monitor:
+        monitor(args.interval)
+        return
+    pw = json_output(['pw-dump'])
+    categories = get_categories(pw)
+    categories.update(get_webcams())
+    print_output(categories)
+
+
 if __name__ == "__main__":
     main()
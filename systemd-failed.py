@@ -1,19 +1,44 @@
 #!/usr/bin/python3 -u
 """
-Description: Improved version of the built-in systemd module.
+Description: Improved version of the built-in systemd module. In monitor
+mode, failed units are tracked with systemd signals over D-Bus instead of
+polling systemctl. The last journal lines of each failed unit are read with
+one journalctl call that starts from where each unit was last read.
 Author: thnikk
 """
-from subprocess import run
+from subprocess import run, Popen, PIPE, DEVNULL
 import json
 import argparse
+import html
+import os
+import time
+import re
+from common import print_debug, Cache
 import tooltip as tt
 
+systemd = 'org.freedesktop.systemd1'
+journal_cache = Cache(os.path.expanduser('~/.cache/systemd-failed.json'))
+# Fields that an entry for a system or user unit can be attributed by
+unit_fields = {
+    'system': [
+        '_SYSTEMD_UNIT', 'UNIT', 'OBJECT_SYSTEMD_UNIT', 'COREDUMP_UNIT'],
+    'user': [
+        '_SYSTEMD_USER_UNIT', 'USER_UNIT', 'OBJECT_SYSTEMD_USER_UNIT',
+        'COREDUMP_USER_UNIT'],
+}
+
 
 def parse_args():
     """ Parse arguments """
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '-e', '--exclude', type=str, help='Comma-separated exclude list')
+    parser.add_argument(
+        '-m', '--monitor', action='store_true',
+        help='Keep running and print when the failed units change')
+    parser.add_argument(
+        '-j', '--journal', type=int, default=3,
+        help='Journal lines to show for each failed unit')
     return parser.parse_args()
 
 
@@ -33,22 +58,104 @@ def filter_services(services, blacklist):
     ]
 
 
-def main():
-    """ Main function """
-    args = parse_args()
+def entry_unit(entry, units):
+    """ Get key of failed unit that journal entry belongs to """
+    for scope, fields in unit_fields.items():
+        for field in fields:
+            if f"{scope}:{entry.get(field)}" in units:
+                return f"{scope}:{entry[field]}"
+    return None
+
+
+def entry_message(entry) -> str:
+    """ Get message from journal entry, which can be a list of bytes """
+    message = entry.get('MESSAGE') or ''
+    if isinstance(message, list):
+        message = bytes(message).decode('utf-8', errors='replace')
+    return message.strip()
+
+
+def get_journal(failed_system, failed_user, count) -> dict:
+    """ Get last journal lines for failed units. Entries are read newest
+    first until every unit has count new lines or reached the last entry read
+    for it before, so a crash looping unit doesn't keep the other units from
+    getting their lines. """
     try:
-        blacklist = args.exclude.split(',')
-    except AttributeError:
-        blacklist = []
-    failed_system = filter_services(
-        get_output(['systemctl', '--failed', '--legend=no']),
-        blacklist
-    )
-    failed_user = filter_services(
-        get_output(['systemctl', '--user', '--failed', '--legend=no']),
-        blacklist
-    )
+        state = journal_cache.load()
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        state = {}
+    units = [f"system:{unit}" for unit in failed_system] + [
+        f"user:{unit}" for unit in failed_user]
+    state = {unit: state.get(unit, {}) for unit in units}
+    if not units or count < 1:
+        return {}
+
+    command = [
+        'journalctl', '--output=json', '--no-pager', '--reverse',
+        '--output-fields=MESSAGE,' + ','.join(
+            field for fields in unit_fields.values() for field in fields)
+    ]
+    # Start from the unit that was read the longest time ago
+    if all('time' in info for info in state.values()):
+        since = min(int(info['time']) for info in state.values())
+        command.append(f'--since=@{since // 1000000}')
+    else:
+        command.append('--boot')
+    for unit in failed_system:
+        command += ['--unit', unit]
+    for unit in failed_user:
+        command += ['--user-unit', unit]
+    started = str(time.time_ns() // 1000)
+    try:
+        process = Popen(command, stdout=PIPE, stderr=DEVNULL)
+    except FileNotFoundError as error:
+        print_debug(f"Couldn't read journal: {error}")
+        return {unit: info.get('lines', []) for unit, info in state.items()}
+
+    # Entries up to the stored cursor of a unit were already read
+    stop = {
+        unit: (info.get('cursor'), int(info.get('time', 0)))
+        for unit, info in state.items()
+    }
+    new = {unit: [] for unit in units}
+    done = set()
+    with process:
+        for line in process.stdout:
+            entry = json.loads(line)
+            unit = entry_unit(entry, new)
+            if unit is None or unit in done:
+                continue
+            if (
+                entry['__CURSOR'] == stop[unit][0] or
+                int(entry['__REALTIME_TIMESTAMP']) < stop[unit][1]
+            ):
+                done.add(unit)
+            else:
+                if not new[unit]:
+                    state[unit]['cursor'] = entry['__CURSOR']
+                    state[unit]['time'] = entry['__REALTIME_TIMESTAMP']
+                new[unit].insert(0, entry_message(entry))
+                if len(new[unit]) >= count:
+                    done.add(unit)
+            # Older entries aren't needed once every unit is done
+            if len(done) == len(units):
+                process.terminate()
+                break
+    if len(done) < len(units) and process.returncode:
+        print_debug(f"Couldn't read journal: exit code {process.returncode}")
+        return {unit: info.get('lines', []) for unit, info in state.items()}
+    # Units without entries were read up to now, so the next read can
+    # start there instead of at the start of the boot
+    for unit in set(units) - done:
+        state[unit].setdefault('time', started)
+    for unit, info in state.items():
+        info['lines'] = (info.get('lines', []) + new[unit])[-count:]
+    journal_cache.save(state)
+    return {unit: info['lines'] for unit, info in state.items()}
+
 
+def get_json(failed_system, failed_user, journal=None) -> str:
+    """ Get output for failed units """
     num_failed = len(failed_system) + len(failed_user)
 
     output = {'text': '', 'tooltip': ''}
@@ -60,12 +167,145 @@ def main():
         for name, failed_list in {
             'System': failed_system, "User": failed_user
         }.items():
-            if failed_list:
-                failed_string = "\n".join(failed_list)
-                output['tooltip'] += f'{name}:\n{failed_string}\n'
+            if not failed_list:
+                continue
+            output['tooltip'] += f'{name}:\n'
+            for unit in failed_list:
+                output['tooltip'] += f'{unit}\n'
+                for line in (journal or {}).get(
+                    f'{name.lower()}:{unit}', []
+                ):
+                    output['tooltip'] += tt.span(
+                        f'  {html.escape(line[:80])}', '#ffffff99') + '\n'
     output['tooltip'] = output['tooltip'].strip()
 
-    print(json.dumps(output))
+    return json.dumps(output)
+
+
+def unit_name(path) -> str:
+    """ Get unit name from escaped object path """
+    return re.sub(
+        '_([0-9a-f]{2})', lambda match: chr(int(match[1], 16)),
+        path.split('/')[-1])
+
+
+class FailedUnits:
+    """ Failed units on one bus, updated from systemd signals """
+    def __init__(self, bus, callback):
+        self.bus = bus
+        self.callback = callback
+        self.units = set()
+        # Only the Unit interface has the active state
+        bus.signal_subscribe(
+            systemd, 'org.freedesktop.DBus.Properties', 'PropertiesChanged',
+            None, f'{systemd}.Unit', 0, self.properties_changed)
+        bus.signal_subscribe(
+            systemd, f'{systemd}.Manager', None, '/org/freedesktop/systemd1',
+            None, 0, self.manager_signal)
+        # Systemd only sends unit signals once a client subscribes
+        self.call('Subscribe')
+        self.list_units()
+
+    def call(self, method):
+        """ Call systemd manager method """
+        return self.bus.call_sync(
+            systemd, '/org/freedesktop/systemd1', f'{systemd}.Manager',
+            method, None, None, 0, -1, None).unpack()
+
+    def list_units(self) -> None:
+        """ Get failed units from systemd """
+        self.units = {
+            unit[0] for unit in self.call('ListUnits')[0]
+            if unit[3] == 'failed'
+        }
+
+    def update(self, name, failed) -> None:
+        """ Add or remove unit and run callback if the set changed """
+        if failed == (name in self.units):
+            return
+        if failed:
+            self.units.add(name)
+        else:
+            self.units.discard(name)
+        self.callback()
+
+    def properties_changed(self, *signal) -> None:
+        """ Update unit when its active state changes """
+        path, parameters = signal[2], signal[5]
+        _, changed, _ = parameters.unpack()
+        if 'ActiveState' in changed:
+            self.update(unit_name(path), changed['ActiveState'] == 'failed')
+
+    def manager_signal(self, *signal) -> None:
+        """ Handle unloaded units and daemon reloads """
+        member, parameters = signal[4], signal[5].unpack()
+        if member == 'UnitRemoved':
+            self.update(parameters[0], False)
+        # The unit list is fetched again when a reload finishes
+        elif member == 'Reloading' and not parameters[0]:
+            units = self.units
+            self.list_units()
+            if units != self.units:
+                self.callback()
+
+
+def monitor(blacklist, count) -> None:
+    """ Print failed units when they change """
+    # pylint: disable=import-outside-toplevel
+    from gi.repository import Gio, GLib
+
+    buses = {}
+    last = None
+
+    def output() -> None:
+        """ Print output if it changed """
+        nonlocal last
+        failed = {
+            name: filter_services(sorted(bus.units), blacklist)
+            for name, bus in buses.items()
+        }
+        failed_system = failed.get('System', [])
+        failed_user = failed.get('User', [])
+        line = get_json(
+            failed_system, failed_user,
+            get_journal(failed_system, failed_user, count))
+        if line != last:
+            print(line)
+            last = line
+
+    for name, bus_type in {
+        'System': Gio.BusType.SYSTEM, 'User': Gio.BusType.SESSION
+    }.items():
+        try:
+            buses[name] = FailedUnits(Gio.bus_get_sync(bus_type, None), output)
+        except GLib.Error as error:
+            print_debug(f"Couldn't connect to {name.lower()} bus: {error}")
+    output()
+    GLib.MainLoop().run()
+
+
+def main():
+    """ Main function """
+    args = parse_args()
+    try:
+        blacklist = args.exclude.split(',')
+    except AttributeError:
+        blacklist = []
+    if args.monitor:
+        monitor(blacklist, args.journal)
+        return
+
+    failed_system = filter_services(
+        get_output(['systemctl', '--failed', '--legend=no']),
+        blacklist
+    )
+    failed_user = filter_services(
+        get_output(['systemctl', '--user', '--failed', '--legend=no']),
+        blacklist
+    )
+    print(get_json(
+        failed_system, failed_user,
+        get_journal(failed_system, failed_user, args.journal)))
 
 
 if __name__ == "__main__":
@@ -1,55 +1,103 @@
 #!/usr/bin/python3 -u
 """
-Description: Waybar module for package updates. Only use this on one bar
-because I don't feel like dealing with race conditions for pulling updates.
+Description: Waybar module for package updates. Instances on multiple bars
+share one refresh through a lock on the cache file.
 Author: thnikk
 """
 import subprocess
 import concurrent.futures
+import argparse
 import json
 import time
 import os
+from glob import glob
 from common import print_debug, Cache, ellipse
 import tooltip as tt
 
 # You can add whatever package manager you want here with the appropriate
 # command. Change the separator and values to get the package and version from
-# each line.
+# each line. The timeout is in seconds and cached results are used for a
+# package manager that doesn't finish in time. In incremental mode, a package
+# manager is only checked again when one of the watched paths is modified or
+# when the ttl (in seconds) runs out.
 config = {
     "Pacman": {
         "command": ["checkupdates"],
         "separator": ' ',
         "empty_error": 2,
-        "values": [0, -1]
+        "values": [0, -1],
+        "timeout": 60,
+        "watch": ["/var/lib/pacman/sync/*.db", "/var/lib/pacman/local"],
+        "ttl": 3600
     },
     "AUR": {
         "command": ["paru", "-Qum"],
         "separator": ' ',
         "empty_error": 1,
-        "values": [0, -1]
+        "values": [0, -1],
+        "timeout": 60,
+        "watch": ["/var/lib/pacman/local", "~/.cache/paru/devel.json"],
+        "ttl": 3600
     },
     "Flatpak": {
         "command": ["flatpak", "remote-ls", "--updates"],
         "separator": '\t',
         "empty_error": 0,
-        "values": [0, 2]
+        "values": [0, 2],
+        "timeout": 30,
+        "watch": ["/var/lib/flatpak/app", "~/.local/share/flatpak/app"],
+        "ttl": 3600
     },
 }
 
 # Alert for these packages
 alerts = ["linux", "discord", "qemu", "libvirt"]
 
-pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(config))
+# Results saved by another instance within this many seconds are used instead
+# of refreshing again, so every bar can run this module.
+lease = 10
 
 
-def get_output(command, separator, values, empty_error) -> list:
+def parse_args():
+    """ Parse arguments """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-i', '--incremental', action='store_true',
+        help='Only check package managers when their state changes')
+    return parser.parse_args()
+
+
+def get_stamp(patterns) -> list:
+    """ Get modification times for watched paths """
+    stamp = []
+    for pattern in patterns:
+        for path in sorted(glob(os.path.expanduser(pattern))):
+            try:
+                stamp.append([path, os.path.getmtime(path)])
+            except FileNotFoundError:
+                pass
+    return stamp
+
+
+def load_cache(cache) -> dict:
+    """ Load cache or return empty dictionary """
+    try:
+        return cache.load()
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+
+
+def get_output(command, separator, values, empty_error, timeout) -> list:
     """ Get formatted command output """
     # Get line-separated output
     while True:
         try:
             output = subprocess.run(
-                command, check=True, capture_output=True
+                command, check=True, capture_output=True, timeout=timeout
             ).stdout.decode('utf-8').splitlines()
+        except subprocess.TimeoutExpired as error:
+            print_debug(f"{command[0]} timed out after {timeout} seconds.")
+            raise ValueError from error
         except subprocess.CalledProcessError as error:
             # Use cache if no updates or command isn't found
             if error.returncode != empty_error and error.returncode != 127:
@@ -103,24 +151,68 @@ def get_total(package_managers) -> int:
     return sum(len(packages) for packages in package_managers.values())
 
 
+def refresh(cache, incremental) -> dict:
+    """ Get updates for all package managers and save them to the cache """
+    state_cache = Cache(os.path.expanduser('~/.cache/updates-state.json'))
+    cached = load_cache(cache)
+    state = load_cache(state_cache)
+    # Initialize dictionary first to set the order based on the config
+    package_managers = {name: [] for name in config}
+    stamps = {name: get_stamp(info["watch"]) for name, info in config.items()}
+    failed = []
+    # Start all package managers at once and collect them as they finish
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(config)
+    ) as pool:
+        futures = {}
+        for name, info in config.items():
+            # Use cached result if nothing changed since the last check
+            try:
+                if (
+                    incremental and name in cached and
+                    state[name]['stamp'] == stamps[name] and
+                    time.time() - state[name]['time'] < info["ttl"]
+                ):
+                    package_managers[name] = cached[name]
+                    continue
+            except KeyError:
+                pass
+            futures[pool.submit(
+                get_output, info["command"], info["separator"],
+                info["values"], info["empty_error"], info["timeout"]
+            )] = name
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                package_managers[name] = future.result()
+                state[name] = {"stamp": stamps[name], "time": time.time()}
+            except ValueError:
+                failed.append(name)
+
+    # Only use the cache for package managers that failed
+    if failed:
+        print_debug(f'Loading {", ".join(failed)} from cache file.')
+        for name in failed:
+            package_managers[name] = cached.get(name, [])
+    if futures:
+        cache.save(package_managers)
+        state_cache.save(state)
+    return package_managers
+
+
 def main() -> None:
     """ Main function """
+    args = parse_args()
     cache = Cache(os.path.expanduser('~/.cache/updates.json'))
-    try:
-        # Initialize dictionary first to set the order based on the config
-        package_managers = {name: [] for name in config}
-        # Get output for each package manager
-        for name, info in config.items():
-            thread = pool.submit(
-                get_output, info["command"], info["separator"], info["values"],
-                info["empty_error"])
-            package_managers[name] = thread.result()
-        pool.shutdown(wait=True)
-        cache.save(package_managers)
-    except ValueError:
-        time.sleep(5)
-        print_debug('Loading data from cache file.')
-        package_managers = cache.load()
+    start = time.time()
+    # Only one instance refreshes at a time and instances that were waiting
+    # on the lock use the result instead of refreshing again.
+    with cache.lock():
+        if cache.modified_since(start - lease):
+            cached = load_cache(cache)
+            package_managers = {name: cached.get(name, []) for name in config}
+        else:
+            package_managers = refresh(cache, args.incremental)
 
     # Create variable for output
     total = get_total(package_managers)
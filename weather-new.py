@@ -1,16 +1,23 @@
 #!/usr/bin/python3 -u
 """
-Description: Newer OpenMeteo weather module that takes a zip code as an
-argument instead of in a config file.
+Description: Newer weather module that takes a zip code as an argument
+instead of in a config file. Uses OpenMeteo unless OpenWeatherMap is set
+with -p. Old data is shown right away while it's refreshed in the
+background. Instances for other locations can be fetched in the same request
+with -l, so one request refreshes every bar. With -m, the module keeps
+running and only prints at the start of each hour or when the data is
+refreshed.
 Author: thnikk
 """
 from datetime import datetime, timedelta
+import threading
+import signal
 import json
+import time
 import os
 import argparse
-import requests
-from common import print_debug, Cache
 import tooltip as tt
+import weather_engine as engine
 
 
 def parse_args():
@@ -24,291 +31,77 @@ def parse_args():
     parser.add_argument(
         '-f', type=int, const=5, nargs='?',
         help="How many hours to show in tooltip (default is 5)")
-    return parser.parse_args()
-
-
-class OpenMeteo():  # pylint: disable=too-few-public-methods
-    """ Class for OpenMeteo """
-    def __init__(self, zip_code):
-        """ Initialize class"""
-        geo = self.__cache__(
-            os.path.expanduser(f"~/.cache/geocode-{zip_code}.json"),
-            "https://geocoding-api.open-meteo.com/v1/search",
-            {
-                "name": zip_code, "count": 1,
-                "language": "en", "format": "json"
-            },
-            zip_code
-        )
-        self.latitude = geo['results'][0]['latitude']
-        self.longitude = geo['results'][0]['longitude']
-        self.timezone = geo['results'][0]['timezone']
-        self.city = geo['results'][0]['name']
-        self.weather = Weather(
-            self.latitude, self.longitude, self.timezone, zip_code)
-        self.pollution = Pollution(
-            self.latitude, self.longitude, self.timezone, zip_code)
-
-    def __cache__(self, path, url, qs, zip_code):
-        """ Update cache file if enough time has passed. """
-        cache = Cache(path)
-        try:
-            data = cache.load()
-            if str(zip_code) not in data['results'][0]['postcodes']:
-                raise ValueError("Updated postcode")
-            # print_debug(f"Loading data from cache at {path}.")
-        except (FileNotFoundError, ValueError):
-            try:
-                print_debug("Fetching new geocode data.")
-                data = requests.get(url, params=qs, timeout=3).json()
-                cache.save(data)
-            except requests.exceptions.ConnectionError:
-                data = cache.load()
-        return data
-
-
-def lookup(code, mode, night=False):
-    """ Get description for weather code """
-    weather_lookup = {
-        0:  ["", "Clear"],
-        1:  ["", "Mostly clear"],
-        2:  ["", "Partly cloudy"],
-        3:  ["", "Overcast"],
-        45: ["", "Fog"],
-        48: ["", "Depositing rime fog"],
-        51: ["", "Light drizzle"],
-        53: ["", "Moderate drizzle"],
-        55: ["", "Dense drizzle"],
-        56: ["", "Light freezing drizzle"],
-        57: ["", "Dense freezing drizzle"],
-        61: ["", "Slight rain"],
-        63: ["", "Moderate rain"],
-        65: ["", "Heavy rain"],
-        66: ["", "Light freezing rain"],
-        67: ["", "Heavy freezing rain"],
-        71: ["", "Slight snow"],
-        73: ["", "Moderate snow"],
-        75: ["", "Heavy snow"],
-        77: ["", "Snow grains"],
-        80: ["", "Slight rain showers"],
-        81: ["", "Moderate rain showers"],
-        82: ["", "Violent rain showers"],
-        85: ["", "Slight snow showers"],
-        86: ["", "Heavy snow showers"],
-        95: ["", "Thunderstorm"],
-        96: ["", "Slight hailing thunderstorm"],
-        99: ["", "Heavy hailing thunderstorm"]
-    }
-    if night:
-        weather_lookup[0][0] = ""
-        weather_lookup[1][0] = ""
-        weather_lookup[2][0] = ""
-    return weather_lookup[code][mode]
-
-
-class Weather():  # pylint: disable=too-few-public-methods
-    """ Get daily weather data """
-    def __init__(self, lat, lon, timezone, zip_code):
-        weather = self.__cache__(
-            os.path.expanduser(f"~/.cache/weather-{zip_code}.json"),
-            "https://api.open-meteo.com/v1/forecast",
-            {
-                "latitude": lat, "longitude": lon,
-                "hourly": [
-                    "temperature_2m", "relativehumidity_2m", "weathercode",
-                    "windspeed_10m", "winddirection_10m",
-                    "apparent_temperature"
-                ],
-                "daily": [
-                    "weathercode", "temperature_2m_max", "temperature_2m_min",
-                    "sunrise,sunset", "wind_speed_10m_max",
-                    "wind_direction_10m_dominant"
-                ],
-                "temperature_unit": "fahrenheit",
-                "timezone": timezone,
-            },
-            timedelta(hours=1)
-        )
-        self.hourly = Hourly(weather)
-        self.daily = Daily(weather)
-
-    def __cache__(self, path, url, qs, delta) -> dict:
-        """ Update cache file if enough time has passed. """
-        cache = Cache(path)
-        try:
-            mtime = datetime.fromtimestamp(os.path.getmtime(path))
-            if (datetime.now() - mtime) > delta:
-                raise ValueError('old')
-            data = cache.load()
-            # print_debug(f"Loading data from cache at {path}.")
-        except (FileNotFoundError, ValueError):
-            try:
-                print_debug("Fetching new data.")
-                data = requests.get(url, params=qs, timeout=3).json()
-                cache.save(data)
-            except requests.exceptions.ConnectionError:
-                data = cache.load()
-        return data
-
-
-class Hourly():
-    """ Parse hourly data and split into objects """
-    def __init__(self, weather):
-        self.weathercodes = weather['hourly']['weathercode']
-        self.temperatures = weather['hourly']['temperature_2m']
-        self.feelslikes = weather['hourly']['apparent_temperature']
-        self.windspeeds = weather['hourly']['windspeed_10m']
-        self.humidities = weather['hourly']['relativehumidity_2m']
-
-    def code(self, index):
-        """ Get weathercode """
-        return self.weathercodes[index]
-
-    def description(self, index):
-        """ Get description """
-        return lookup(self.code(index), 1)
-
-    def icon(self, index, night=False):
-        """ Get icon """
-        return lookup(self.code(index), 0, night)
-
-    def temp(self, index):
-        """ Get temperature """
-        return round(self.temperatures[index])
-
-    def feelslike(self, index):
-        """ Get temperature """
-        return round(self.feelslikes[index])
-
-    def wind(self, index):
-        """ Get windspeed """
-        return self.windspeeds[index]
-
-    def humidity(self, index):
-        """ Get humidity """
-        return self.humidities[index]
-
-
-class Daily():
-    """ Parse daily data and split into objects """
-    def __init__(self, weather):
-        self.sunrise = int(datetime.strptime(
-            weather["daily"]["sunrise"][0],
-            "%Y-%m-%dT%H:%M").strftime("%H"))
-        self.sunset = int(datetime.strptime(
-            weather["daily"]["sunset"][0],
-            "%Y-%m-%dT%H:%M").strftime("%H"))
-        self.weathercodes = weather['daily']['weathercode']
-        self.lows = weather['daily']['temperature_2m_min']
-        self.highs = weather['daily']['temperature_2m_max']
-        self.windspeeds = weather['daily']['wind_speed_10m_max']
-        self.winddirs = weather['daily']['wind_direction_10m_dominant']
-
-    def code(self, index):
-        """ Get weathercode """
-        return self.weathercodes[index]
-
-    def description(self, index) -> str:
-        """ Get description of weather """
-        return lookup(self.code(index), 1)
-
-    def icon(self, index, night=False):
-        """ Get icon """
-        return lookup(self.code(index), 0, night)
-
-    def low(self, index) -> int:
-        """ Get min temperature """
-        return round(self.lows[index])
-
-    def high(self, index) -> int:
-        """ Get max temperature """
-        return round(self.highs[index])
-
-    def wind(self, index) -> int:
-        """ Get max wind speed """
-        return round(self.windspeeds[index])
+    parser.add_argument(
+        '-s', '--signal', type=int,
+        help="Signal to send waybar (or the daemon running the module) after "
+        "refreshing in the background, or to reload on with -m")
+    parser.add_argument(
+        '-l', '--locations', type=str, nargs='+', default=[],
+        help="Zip codes of other instances to fetch in the same request")
+    parser.add_argument(
+        '-m', '--monitor', action='store_true',
+        help="Keep running and print at the start of each hour")
+    parser.add_argument(
+        '-p', '--provider', type=str, default='open-meteo',
+        choices=['open-meteo', 'owm'], help="Weather provider")
+    parser.add_argument(
+        '-k', '--api-key', type=str, help="API key for OpenWeatherMap")
+    parser.add_argument(
+        '-c', '--country', type=str, default='',
+        help="Country code of the zip code, for OpenWeatherMap or imported "
+        "postal codes of several countries")
+    args = parser.parse_args()
+    if args.provider == 'owm' and not args.api_key:
+        parser.error("OpenWeatherMap needs an API key (-k)")
+    return args
 
-    def direction(self, index) -> int:
-        """ Get max wind speed """
-        return round(self.winddirs[index])
 
+def get_provider(args):
+    """ Get provider from arguments """
+    if args.provider == 'owm':
+        return engine.OpenWeatherMap(args.api_key, args.country)
+    return engine.OpenMeteo(args.country)
 
-class Pollution():
-    """ Get daily polution data """
-    def __init__(self, lat, lon, timezone, zip_code) -> None:
-        pollution = self.__cache__(
-            os.path.expanduser(f"~/.cache/pollution-{zip_code}.json"),
-            "https://air-quality-api.open-meteo.com/v1/air-quality",
-            {
-                "latitude": lat, "longitude": lon, "hourly": "us_aqi",
-                "timezone": timezone,
-            },
-            timedelta(days=1)
-        )
-        self.aqi = pollution["hourly"]["us_aqi"]
 
-    def __cache__(self, path, url, qs, delta) -> dict:
-        """ Update cache file if enough time has passed. """
-        cache = Cache(path)
+def next_hours(forecast, now, hours) -> list:
+    """ Get times for the next hours that have data """
+    times = []
+    for hour in range(1, (hours or 5) + 1):
+        when = now + timedelta(hours=hour)
         try:
-            mtime = datetime.fromtimestamp(os.path.getmtime(path))
-            if (datetime.now() - mtime) > delta:
-                raise ValueError('old')
-            data = cache.load()
-            # print_debug(f"Loading data from cache at {path}.")
-        except (FileNotFoundError, ValueError):
-            try:
-                print_debug("Fetching new data.")
-                data = requests.get(url, params=qs, timeout=3).json()
-                cache.save(data)
-            except requests.exceptions.ConnectionError:
-                data = cache.load()
-        return data
+            forecast.hourly.index(when)
+        except IndexError:
+            break
+        times.append(when)
+    return times
 
-    def __aqi_to_desc__(self, value) -> str:
-        """ Get description for aqi """
-        for desc in [
-            (50, "Good"), (100, "Moderate"), (150, "Unhealthy"),
-            (200, "Unhealthy"), (300, "Very unhealthy"), (500, "Hazardous")
-        ]:
-            if 0 < value < desc[0]:
-                return desc[1]
-        return "Unknown"
 
-    def description(self, index) -> str:
-        """ Get air quality description for given hour """
-        return self.__aqi_to_desc__(self.aqi[index])
-
-
-def tooltip(om, index, hours) -> str:
+def tooltip(forecast, now, hours) -> str:
     """ Generate tooltip """
-
-    if om.weather.daily.sunset > index > om.weather.daily.sunrise:
-        sun_status = f"Sunset at {om.weather.daily.sunset - 12}PM\n"
+    daily = forecast.daily
+    if daily.sunset(now) > now.hour > daily.sunrise(now):
+        sun_status = f"Sunset at {daily.sunset(now) - 12}PM\n"
     else:
-        sun_status = f"Sunrise at {om.weather.daily.sunrise}AM\n"
+        sun_status = f"Sunrise at {daily.sunrise(now)}AM\n"
 
     output = (
         tt.heading('Today') + '\n'
-        f"City: {om.city}\n"
-        f"Description: {om.weather.hourly.description(index)}\n"
-        f"Temperature: {om.weather.hourly.temp(index)}\n"
-        f"Feels like: {om.weather.hourly.feelslike(index)}\n"
-        f"Humidity: {om.weather.hourly.humidity(index)}%\n"
-        f"Wind: {om.weather.hourly.wind(index)} mph\n"
-        f"Air quality: {om.pollution.description(index)}\n"
+        f"City: {forecast.city}\n"
+        f"Description: {forecast.hourly.description(now)}\n"
+        f"Temperature: {forecast.hourly.temp(now)}\n"
+        f"Feels like: {forecast.hourly.feelslike(now)}\n"
+        f"Humidity: {forecast.hourly.humidity(now)}%\n"
+        f"Wind: {forecast.hourly.wind(now)} mph\n"
+        f"Air quality: {forecast.air.description(now)}\n"
         f"{sun_status}"
         '\n' + tt.heading('Hourly forecast') + '\n'
     )
 
     hourly_output = []
-    for hour in range(1, (hours or 5) + 1):
-        hour_index = int(
-            (datetime.now() + timedelta(hours=hour)).strftime('%H'))
-        text = (datetime.now() + timedelta(hours=hour)).strftime("%l%P")
+    for when in next_hours(forecast, now, hours):
         hourly_output.append(
-            f"{text}: {om.weather.hourly.temp(hour_index)} "
-            f"{om.weather.hourly.description(hour_index)}"
+            f"{when.strftime('%l%P')}: {forecast.hourly.temp(when)} "
+            f"{forecast.hourly.description(when)}"
         )
     # Strip whitespace from hour if all shown hours have whitespace
     if set(item[0] for item in hourly_output) == {' '}:
@@ -317,36 +110,38 @@ def tooltip(om, index, hours) -> str:
 
     output += '\n' + tt.heading('Weekly forecast') + '\n'
 
+    # Providers with shorter forecasts don't cover every day
     for day in range(0, 6):
-        abbr = (datetime.now() + timedelta(days=day)).strftime('%A')[:2]
-        output += (
-            f"{abbr}: "
-            f"{om.weather.daily.low(day)}/{om.weather.daily.high(day)} "
-            f"{om.weather.daily.wind(day)} "
-            f"{om.weather.daily.description(day)}\n"
-        )
+        date = now + timedelta(days=day)
+        try:
+            output += (
+                f"{date.strftime('%A')[:2]}: "
+                f"{daily.low(date)}/{daily.high(date)} "
+                f"{daily.wind(date)} "
+                f"{daily.description(date)}\n"
+            )
+        except IndexError:
+            break
     return output.strip()
 
 
-def widget(om, index, hours, night) -> dict:
+def widget(forecast, now, hours, night) -> dict:
     """ Generate tooltip """
 
-    hourly = om.weather.hourly
-    night_now = (
-        om.weather.daily.sunrise > datetime.now().hour
-        or datetime.now().hour > om.weather.daily.sunset) and night
+    hourly = forecast.hourly
+    daily = forecast.daily
     output = {
-        "City": om.city,
+        "City": forecast.city,
         "Today": {
             "icon-class": "icon-large",
             "info": [{
-                "icon": hourly.icon(index, night_now),
-                "description": hourly.description(index),
-                "temperature": hourly.temp(index),
-                "feels_like": hourly.feelslike(index),
-                "humidity": hourly.humidity(index),
-                "wind": hourly.wind(index),
-                "quality": om.pollution.description(index)
+                "icon": hourly.icon(now, daily.night(now) and night),
+                "description": hourly.description(now),
+                "temperature": hourly.temp(now),
+                "feels_like": hourly.feelslike(now),
+                "humidity": hourly.humidity(now),
+                "wind": hourly.wind(now),
+                "quality": forecast.air.description(now)
             }]
         },
         "Hourly": {
@@ -357,39 +152,36 @@ def widget(om, index, hours, night) -> dict:
         }
     }
 
-    if om.weather.daily.sunset > index > om.weather.daily.sunrise:
-        output["Today"]["info"][0]["sunset"] = om.weather.daily.sunset - 12
+    if daily.sunset(now) > now.hour > daily.sunrise(now):
+        output["Today"]["info"][0]["sunset"] = daily.sunset(now) - 12
     else:
-        output["Today"]["info"][0]["sunrise"] = om.weather.daily.sunrise
+        output["Today"]["info"][0]["sunrise"] = daily.sunrise(now)
 
     hourly_output = []
-    for hour in range(1, (hours or 5) + 1):
-        hour_index = int(
-            (datetime.now() + timedelta(hours=hour)).strftime('%H'))
-        text = (datetime.now() + timedelta(hours=hour)).strftime("%l%P")
-        night_hour = (
-            om.weather.daily.sunrise > hour_index
-            or hour_index > om.weather.daily.sunset) and night
+    for when in next_hours(forecast, now, hours):
         hourly_output.append({
-            "icon": om.weather.hourly.icon(hour_index, night_hour),
-            "description": om.weather.hourly.description(hour_index),
-            "humidity": om.weather.hourly.humidity(hour_index),
-            "time": text,
-            "temperature": om.weather.hourly.temp(hour_index)
+            "icon": hourly.icon(when, daily.night(when) and night),
+            "description": hourly.description(when),
+            "humidity": hourly.humidity(when),
+            "time": when.strftime("%l%P"),
+            "temperature": hourly.temp(when)
         })
     output["Hourly"]["info"] = hourly_output
 
     daily_output = []
     for day in range(0, 5):
-        abbr = (datetime.now() + timedelta(days=day)).strftime('%A')
-        daily_output.append({
-            "time": abbr,
-            "high": om.weather.daily.high(day),
-            "low": om.weather.daily.low(day),
-            "wind": om.weather.daily.wind(day),
-            "description": om.weather.daily.description(day),
-            "icon": om.weather.daily.icon(day)
-        })
+        date = now + timedelta(days=day)
+        try:
+            daily_output.append({
+                "time": date.strftime('%A'),
+                "high": daily.high(date),
+                "low": daily.low(date),
+                "wind": daily.wind(date),
+                "description": daily.description(date),
+                "icon": daily.icon(date)
+            })
+        except IndexError:
+            break
     output["Daily"]["info"] = daily_output
     with open(
         os.path.expanduser('~/.cache/weather-widget.json'),
@@ -399,24 +191,65 @@ def widget(om, index, hours, night) -> dict:
     return output
 
 
-def main():
-    """ Main function """
-    args = parse_args()
-    om = OpenMeteo(args.zip)
+def get_output(forecast, args) -> str:
+    """ Get output for the current hour """
     now = datetime.now()
-    hour_now = int(now.strftime('%H'))
-    night = (
-        om.weather.daily.sunrise > hour_now
-        or hour_now > om.weather.daily.sunset) and args.n
-
-    print(json.dumps(
+    if not forecast.covers(now):
+        return engine.no_data()
+    night = forecast.daily.night(now) and args.n
+    return json.dumps(
         {
-            "text": f"{om.weather.hourly.icon(hour_now, night)} "
-            f"{om.weather.hourly.temp(hour_now)}°F",
-            "tooltip": tooltip(om, hour_now, args.f),
-            "widget": widget(om, hour_now, args.f, args.n)
+            "text": f"{forecast.hourly.icon(now, night)} "
+            f"{forecast.hourly.temp(now)}°F",
+            "tooltip": tooltip(forecast, now, args.f),
+            "widget": widget(forecast, now, args.f, args.n)
         }
-    ))
+    )
+
+
+def monitor(args) -> None:
+    """ Keep forecast in memory and print at the start of each hour, when
+    the cache gets too old or when the signal is received """
+    wake = threading.Event()
+    if args.signal and threading.current_thread() is threading.main_thread():
+        signal.signal(
+            signal.SIGRTMIN + args.signal, lambda *_: wake.set())
+    provider = get_provider(args)
+    forecast = engine.get_forecast(
+        provider, args.zip, args.locations, wait=True)
+    last = None
+    while True:
+        line = get_output(forecast, args)
+        if line != last:
+            print(line)
+            last = line
+        now = datetime.now()
+        next_hour = (
+            now.replace(minute=0, second=0, microsecond=0) +
+            timedelta(hours=1)).timestamp()
+        # Wait a few minutes before trying again if refreshing failed
+        expires = max(
+            min(forecast.state.expiry.values(), default=next_hour),
+            time.time() + 300)
+        # Wake up just after the hour starts
+        if wake.wait(min(next_hour + 1, expires) - time.time()) or (
+            time.time() >= expires
+        ):
+            forecast = engine.get_forecast(
+                provider, args.zip, args.locations, wait=True)
+        wake.clear()
+
+
+def main():
+    """ Main function """
+    args = parse_args()
+    if args.monitor:
+        monitor(args)
+        return
+    forecast = engine.get_forecast(
+        get_provider(args), args.zip, args.locations)
+    print(get_output(forecast, args))
+    engine.refresh_after_output(forecast, args.signal)
 
 
 if __name__ == "__main__":
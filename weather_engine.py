@@ -0,0 +1,624 @@
+#!/usr/bin/python3 -u
+"""
+Description: Weather engine shared by the weather modules. Providers turn
+their responses into the same hourly, daily and air quality series, and all
+responses go through one cache. Old data is returned right away and marked
+stale so modules can refresh it after printing.
+Author: thnikk
+"""
+from datetime import datetime, timedelta
+from bisect import bisect_right
+from subprocess import run
+from array import array
+from math import nan
+import concurrent.futures
+import threading
+import signal
+import json
+import time
+import sys
+import os
+import requests
+from common import print_debug, Cache
+import postcodes
+
+# Shared session so connections are reused between requests
+session = requests.Session()
+
+
+def lookup(code, mode, night=False):
+    """ Get description for weather code """
+    weather_lookup = {
+        0:  ["", "Clear"],
+        1:  ["", "Mostly clear"],
+        2:  ["", "Partly cloudy"],
+        3:  ["", "Overcast"],
+        45: ["", "Fog"],
+        48: ["", "Depositing rime fog"],
+        51: ["", "Light drizzle"],
+        53: ["", "Moderate drizzle"],
+        55: ["", "Dense drizzle"],
+        56: ["", "Light freezing drizzle"],
+        57: ["", "Dense freezing drizzle"],
+        61: ["", "Slight rain"],
+        63: ["", "Moderate rain"],
+        65: ["", "Heavy rain"],
+        66: ["", "Light freezing rain"],
+        67: ["", "Heavy freezing rain"],
+        71: ["", "Slight snow"],
+        73: ["", "Moderate snow"],
+        75: ["", "Heavy snow"],
+        77: ["", "Snow grains"],
+        80: ["", "Slight rain showers"],
+        81: ["", "Moderate rain showers"],
+        82: ["", "Violent rain showers"],
+        85: ["", "Slight snow showers"],
+        86: ["", "Heavy snow showers"],
+        95: ["", "Thunderstorm"],
+        96: ["", "Slight hailing thunderstorm"],
+        99: ["", "Heavy hailing thunderstorm"]
+    }
+    if night:
+        weather_lookup[0][0] = ""
+        weather_lookup[1][0] = ""
+        weather_lookup[2][0] = ""
+    return weather_lookup[code][mode]
+
+
+def aqi_description(value) -> str:
+    """ Get description for US AQI """
+    for desc in [
+        (50, "Good"), (100, "Moderate"), (150, "Unhealthy"),
+        (200, "Unhealthy"), (300, "Very unhealthy"), (500, "Hazardous")
+    ]:
+        if 0 < value < desc[0]:
+            return desc[1]
+    return "Unknown"
+
+
+def fetch(paths, url, qs, timeout=3) -> dict:
+    """ Fetch data for all locations and save it to their cache files """
+    response = session.get(url, params=qs, timeout=timeout)
+    response.raise_for_status()
+    data = response.json()
+    # Multiple locations are returned as a list in the same order
+    results = data if isinstance(data, list) else [data]
+    if len(results) != len(paths):
+        raise ValueError(f"Expected {len(paths)} locations from {url}")
+    for path, result in zip(paths, results):
+        Cache(path).save(result)
+    return results[0]
+
+
+class CacheState():  # pylint: disable=too-few-public-methods
+    """ Cache files loaded for one forecast. Each forecast has its own, so
+    modules run in threads by the daemon don't share them. """
+    def __init__(self):
+        # Cache files that are too old, which are refreshed after printing
+        self.stale = []
+        # Times that loaded cache files get too old
+        self.expiry = {}
+
+
+def load(paths, url, qs, delta=None, state=None) -> dict:
+    """ Load data for the first location from its cache file and mark it in
+    the state for refreshing if enough time has passed. Data is only fetched
+    right away if there is no cache. Data without a delta never gets old. """
+    cache = Cache(paths[0])
+    try:
+        data = cache.load()
+        if delta is not None:
+            state.expiry[paths[0]] = (
+                os.path.getmtime(paths[0]) + delta.total_seconds())
+            if time.time() > state.expiry[paths[0]]:
+                state.stale.append((paths, url, qs))
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        print_debug("Fetching new data.")
+        data = fetch(paths, url, qs)
+        if delta is not None:
+            state.expiry[paths[0]] = time.time() + delta.total_seconds()
+    return data
+
+
+def refresh(jobs) -> None:
+    """ Fetch data for stale cache files and replace them """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        futures = [pool.submit(fetch, *job, timeout=10) for job in jobs]
+    for future in futures:
+        try:
+            future.result()
+        except (requests.exceptions.RequestException, ValueError) as error:
+            print_debug(f"Couldn't refresh weather data: {error}")
+
+
+def refresh_stale(jobs) -> list:
+    """ Refresh stale cache files unless another instance refreshed them in
+    the meantime and return the jobs that were run """
+    with Cache(os.path.expanduser('~/.cache/weather-refresh')).lock():
+        jobs = [
+            job for job in jobs
+            if not Cache(job[0][0]).modified_since(time.time() - 60)
+        ]
+        if jobs:
+            refresh(jobs)
+    return jobs
+
+
+def refresh_in_background(jobs, waybar_signal=None) -> bool:
+    """ Refresh stale cache files in a child process so waybar gets the
+    output without waiting. Returns True in the child process. """
+    if os.fork():
+        return False
+    # Detach from waybar, which waits for stdout to close
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    if refresh_stale(jobs) and waybar_signal:
+        run(['pkill', f'-RTMIN+{waybar_signal}', 'waybar'], check=False)
+    return True
+
+
+def refresh_in_thread(jobs, module_signal=None) -> None:
+    """ Refresh stale cache files and signal this process, which is how the
+    daemon runs modules again """
+    if not refresh_stale(jobs) or not module_signal:
+        return
+    # Signals without a handler would end the process
+    if signal.getsignal(signal.SIGRTMIN + module_signal) not in (
+        signal.SIG_DFL, signal.SIG_IGN, None
+    ):
+        os.kill(os.getpid(), signal.SIGRTMIN + module_signal)
+
+
+def refresh_after_output(forecast, waybar_signal=None) -> None:
+    """ Refresh stale data of forecast once the output is printed """
+    sys.stdout.flush()
+    stale = forecast.state.stale
+    if not stale:
+        return
+    # Forking while other threads hold locks can deadlock the child, so
+    # modules run in a thread by the daemon refresh in a thread instead
+    if threading.current_thread() is not threading.main_thread():
+        threading.Thread(
+            target=refresh_in_thread, args=(list(stale), waybar_signal),
+            daemon=True).start()
+        return
+    if refresh_in_background(list(stale), waybar_signal):
+        os._exit(0)  # pylint: disable=protected-access
+
+
+class Series():
+    """ Columns of values stored in arrays and looked up by time. Each time
+    covers the hours or days until the next one, so providers with three
+    hour forecasts can be looked up by hour. """
+    def __init__(self, times, columns, hourly=True):
+        self.hourly = hourly
+        self.keys = array('l', (self.key(when) for when in times))
+        self.columns = {
+            field: array('f', (
+                nan if value is None else value for value in values))
+            for field, values in columns.items()
+        }
+        steps = [
+            after - before for before, after in zip(self.keys, self.keys[1:])
+            if after > before
+        ]
+        self.step = max(set(steps), key=steps.count) if steps else 1
+
+    def key(self, when) -> int:
+        """ Get key for hour or day of date """
+        if self.hourly:
+            return when.toordinal() * 24 + when.hour
+        return when.toordinal()
+
+    def index(self, when) -> int:
+        """ Get index for time """
+        key = self.key(when)
+        if not self.keys:
+            raise IndexError(f"No data for {when}")
+        # Times are evenly spaced unless the clock changed for DST
+        index = (key - self.keys[0]) // self.step
+        if not (
+            0 <= index < len(self.keys) and
+            self.keys[index] <= key < self.keys[index] + self.step and
+            (index + 1 == len(self.keys) or key < self.keys[index + 1])
+        ):
+            index = bisect_right(self.keys, key) - 1
+        if index < 0 or key - self.keys[index] >= self.step:
+            raise IndexError(f"No data for {when}")
+        return index
+
+    def value(self, field, when) -> float:
+        """ Get value of field at time """
+        return self.columns[field][self.index(when)]
+
+    def values(self, field, start, count) -> array:
+        """ Get values of field for count steps from start """
+        index = self.index(start)
+        return self.columns[field][index:index + count]
+
+
+class Hourly(Series):
+    """ Hourly data by time """
+    def code(self, when):
+        """ Get weathercode """
+        return int(self.value('code', when))
+
+    def description(self, when):
+        """ Get description """
+        return lookup(self.code(when), 1)
+
+    def icon(self, when, night=False):
+        """ Get icon """
+        return lookup(self.code(when), 0, night)
+
+    def temp(self, when):
+        """ Get temperature """
+        return round(self.value('temperature', when))
+
+    def feelslike(self, when):
+        """ Get temperature """
+        return round(self.value('feels_like', when))
+
+    def wind(self, when):
+        """ Get windspeed """
+        return round(self.value('wind', when), 1)
+
+    def direction(self, when):
+        """ Get wind direction """
+        return round(self.value('wind_direction', when))
+
+    def humidity(self, when):
+        """ Get humidity """
+        return round(self.value('humidity', when))
+
+
+class Daily(Series):
+    """ Daily data by date """
+    def __init__(self, times, columns):
+        super().__init__(times, columns, hourly=False)
+
+    def code(self, day):
+        """ Get weathercode """
+        return int(self.value('code', day))
+
+    def description(self, day) -> str:
+        """ Get description of weather """
+        return lookup(self.code(day), 1)
+
+    def icon(self, day, night=False):
+        """ Get icon """
+        return lookup(self.code(day), 0, night)
+
+    def low(self, day) -> int:
+        """ Get min temperature """
+        return round(self.value('low', day))
+
+    def high(self, day) -> int:
+        """ Get max temperature """
+        return round(self.value('high', day))
+
+    def wind(self, day) -> int:
+        """ Get max wind speed """
+        return round(self.value('wind', day))
+
+    def direction(self, day) -> int:
+        """ Get max wind speed """
+        return round(self.value('wind_direction', day))
+
+    def sunrise(self, day) -> int:
+        """ Get hour of sunrise """
+        return int(self.value('sunrise', day))
+
+    def sunset(self, day) -> int:
+        """ Get hour of sunset """
+        return int(self.value('sunset', day))
+
+    def night(self, when) -> bool:
+        """ Check if time is before sunrise or after sunset on its day """
+        return not self.sunrise(when) <= when.hour <= self.sunset(when)
+
+
+class AirQuality(Series):
+    """ Hourly US AQI by time """
+    def description(self, when) -> str:
+        """ Get air quality description for given hour """
+        try:
+            return aqi_description(self.value('aqi', when))
+        except IndexError:
+            return "Unknown"
+
+
+class Forecast():  # pylint: disable=too-few-public-methods
+    """ Forecast for a location that looks the same for every provider.
+    Temperatures are in fahrenheit and wind speeds in mph. """
+    def __init__(self, city, hourly, daily, air, state):
+        self.city = city
+        self.hourly = hourly
+        self.daily = daily
+        self.air = air
+        self.state = state
+
+    def covers(self, when) -> bool:
+        """ Check if there is hourly data for time """
+        try:
+            self.hourly.index(when)
+        except IndexError:
+            return False
+        return True
+
+
+class OpenMeteo():
+    """ Open-Meteo provider, which fetches several locations at once """
+    batched = True
+
+    def __init__(self, country_code=''):
+        self.country_code = country_code
+
+    def locate(self, zip_code) -> dict:
+        """ Get coordinates and name for zip code """
+        # Use the offline index if postal codes were imported
+        location = postcodes.lookup(zip_code, self.country_code or None)
+        if location:
+            return {"zip": zip_code, **location}
+        geo = load(
+            [os.path.expanduser(f"~/.cache/geocode-{zip_code}.json")],
+            "https://geocoding-api.open-meteo.com/v1/search",
+            {
+                "name": zip_code, "count": 1,
+                "language": "en", "format": "json"
+            }
+        )
+        return {
+            "zip": zip_code, "latitude": geo['results'][0]['latitude'],
+            "longitude": geo['results'][0]['longitude'],
+            "timezone": geo['results'][0]['timezone'],
+            "name": geo['results'][0]['name']
+        }
+
+    def batch(self, name, locations) -> tuple:
+        """ Get cache files and parameters to fetch all locations at once """
+        paths = [
+            os.path.expanduser(f"~/.cache/{name}-{location['zip']}.json")
+            for location in locations
+        ]
+        # Open-Meteo takes comma-separated lists for multiple locations
+        params = {
+            key: ",".join(str(location[key]) for location in locations)
+            for key in ["latitude", "longitude", "timezone"]
+        }
+        return paths, params
+
+    def forecast(self, locations) -> Forecast:
+        """ Get forecast for the first location. Other locations are saved
+        to their own cache files. """
+        paths, params = self.batch('weather', locations)
+        weather_job = (
+            paths, "https://api.open-meteo.com/v1/forecast",
+            {
+                **params,
+                "hourly": [
+                    "temperature_2m", "relativehumidity_2m", "weathercode",
+                    "windspeed_10m", "winddirection_10m",
+                    "apparent_temperature"
+                ],
+                "daily": [
+                    "weathercode", "temperature_2m_max", "temperature_2m_min",
+                    "sunrise,sunset", "wind_speed_10m_max",
+                    "wind_direction_10m_dominant"
+                ],
+                # Only the next hours are shown, so skip the rest of the week
+                "forecast_hours": 48,
+                "temperature_unit": "fahrenheit",
+                "wind_speed_unit": "mph",
+            },
+            timedelta(hours=1)
+        )
+        paths, params = self.batch('pollution', locations)
+        pollution_job = (
+            paths, "https://air-quality-api.open-meteo.com/v1/air-quality",
+            {**params, "hourly": "us_aqi", "forecast_hours": 48},
+            timedelta(days=1)
+        )
+        # Forecast and air quality only need the location, so get them at
+        # the same time
+        state = CacheState()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+            weather = pool.submit(load, *weather_job, state)
+            pollution = pool.submit(load, *pollution_job, state)
+        weather, pollution = weather.result(), pollution.result()
+
+        hourly = weather['hourly']
+        daily = weather['daily']
+        return Forecast(
+            locations[0]['name'],
+            Hourly(map(datetime.fromisoformat, hourly['time']), {
+                "code": hourly['weathercode'],
+                "temperature": hourly['temperature_2m'],
+                "feels_like": hourly['apparent_temperature'],
+                "humidity": hourly['relativehumidity_2m'],
+                "wind": hourly['windspeed_10m'],
+                "wind_direction": hourly['winddirection_10m'],
+            }),
+            Daily(map(datetime.fromisoformat, daily['time']), {
+                "code": daily['weathercode'],
+                "low": daily['temperature_2m_min'],
+                "high": daily['temperature_2m_max'],
+                "wind": daily['wind_speed_10m_max'],
+                "wind_direction": daily['wind_direction_10m_dominant'],
+                "sunrise": [
+                    datetime.fromisoformat(when).hour
+                    for when in daily['sunrise']],
+                "sunset": [
+                    datetime.fromisoformat(when).hour
+                    for when in daily['sunset']],
+            }),
+            AirQuality(
+                map(datetime.fromisoformat, pollution['hourly']['time']),
+                {"aqi": pollution['hourly']['us_aqi']}),
+            state
+        )
+
+
+def owm_code(condition) -> int:
+    """ Get weathercode for OpenWeatherMap condition """
+    codes = {
+        500: 61, 501: 63, 511: 66, 600: 71, 601: 73, 602: 75,
+        800: 0, 801: 1, 802: 2, 803: 3, 804: 3
+    }
+    if condition in codes:
+        return codes[condition]
+    if 620 <= condition < 700:
+        return 85
+    return {
+        2: 95, 3: 53, 5: 65 if condition < 520 else 81, 6: 77, 7: 45
+    }.get(condition // 100, 3)
+
+
+class OpenWeatherMap():
+    """ OpenWeatherMap provider, which needs an API key and fetches each
+    location on its own """
+    url = "https://api.openweathermap.org"
+    batched = False
+
+    def __init__(self, api_key, country_code=''):
+        self.api_key = api_key
+        self.country_code = country_code
+
+    def locate(self, zip_code) -> dict:
+        """ Get coordinates and name for zip code """
+        geo = load(
+            [os.path.expanduser(f"~/.cache/owm-geocode-{zip_code}.json")],
+            f"{self.url}/geo/1.0/zip",
+            {
+                "zip": ",".join(
+                    part for part in [zip_code, self.country_code] if part),
+                "appid": self.api_key
+            }
+        )
+        return {
+            "zip": zip_code, "latitude": geo['lat'],
+            "longitude": geo['lon'], "timezone": None, "name": geo['name']
+        }
+
+    def forecast(self, locations) -> Forecast:
+        """ Get forecast for the first location """
+        location = locations[0]
+        params = {
+            "lat": location['latitude'], "lon": location['longitude'],
+            "units": "imperial", "appid": self.api_key
+        }
+        jobs = [
+            (
+                [os.path.expanduser(
+                    f"~/.cache/owm-{name}-{location['zip']}.json")],
+                f"{self.url}/data/2.5/{endpoint}", params, delta
+            ) for name, endpoint, delta in [
+                ("weather", "weather", timedelta(minutes=30)),
+                ("forecast", "forecast", timedelta(hours=1)),
+                ("pollution", "air_pollution/forecast", timedelta(hours=6)),
+            ]
+        ]
+        state = CacheState()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as pool:
+            futures = [pool.submit(load, *job, state) for job in jobs]
+        current, forecast, pollution = [future.result() for future in futures]
+
+        # The current weather fills the hours before the first forecast
+        entries = [current] + [
+            entry for entry in forecast['list'] if entry['dt'] > current['dt']]
+        times = [datetime.fromtimestamp(entry['dt']) for entry in entries]
+
+        days = {}
+        for when, entry in zip(times, entries):
+            days.setdefault(when.date(), []).append(entry)
+        sunrise = datetime.fromtimestamp(current['sys']['sunrise']).hour
+        sunset = datetime.fromtimestamp(current['sys']['sunset']).hour
+        daily_codes = []
+        for day in days.values():
+            day_codes = [owm_code(entry['weather'][0]['id']) for entry in day]
+            daily_codes.append(max(set(day_codes), key=day_codes.count))
+        windiest = [
+            max(day, key=lambda entry: entry['wind']['speed'])
+            for day in days.values()
+        ]
+        # OpenWeatherMap uses an index from 1 to 5 instead of the US AQI
+        aqi = [25, 75, 125, 175, 250]
+
+        return Forecast(
+            location['name'],
+            Hourly(times, {
+                "code": [
+                    owm_code(entry['weather'][0]['id']) for entry in entries],
+                "temperature": [entry['main']['temp'] for entry in entries],
+                "feels_like": [
+                    entry['main']['feels_like'] for entry in entries],
+                "humidity": [entry['main']['humidity'] for entry in entries],
+                "wind": [entry['wind']['speed'] for entry in entries],
+                "wind_direction": [
+                    entry['wind'].get('deg', 0) for entry in entries],
+            }),
+            Daily(
+                [datetime.combine(day, datetime.min.time()) for day in days],
+                {
+                    "code": daily_codes,
+                    "low": [
+                        min(entry['main']['temp_min'] for entry in day)
+                        for day in days.values()],
+                    "high": [
+                        max(entry['main']['temp_max'] for entry in day)
+                        for day in days.values()],
+                    "wind": [entry['wind']['speed'] for entry in windiest],
+                    "wind_direction": [
+                        entry['wind'].get('deg', 0) for entry in windiest],
+                    "sunrise": [sunrise] * len(days),
+                    "sunset": [sunset] * len(days),
+                }
+            ),
+            AirQuality(
+                [
+                    datetime.fromtimestamp(entry['dt'])
+                    for entry in pollution['list']],
+                {"aqi": [
+                    aqi[entry['main']['aqi'] - 1]
+                    for entry in pollution['list']]}),
+            state
+        )
+
+
+def read_forecast(provider, zip_code, others) -> Forecast:
+    """ Get forecast for zip code from cache or the provider """
+    locations = [provider.locate(zip_code)]
+    for other in others if provider.batched else []:
+        if other == zip_code:
+            continue
+        # Other locations can't keep this one from being shown
+        try:
+            locations.append(provider.locate(other))
+        except (KeyError, IndexError):
+            print_debug(f"Skipping unknown location {other}.")
+        except (requests.exceptions.RequestException, ValueError) as error:
+            print_debug(f"Skipping location {other}: {error}")
+    return provider.forecast(locations)
+
+
+def no_data() -> str:
+    """ Get output for when there's no data for the current hour, which
+    happens if old data couldn't be refreshed """
+    return json.dumps({
+        "text": "No data",
+        "tooltip": "Weather data is out of date and couldn't be refreshed"
+    })
+
+
+def get_forecast(provider, zip_code, others=(), wait=False) -> Forecast:
+    """ Get forecast for zip code. Providers that can fetch several
+    locations at once also refresh the other locations. Stale data is
+    returned unless wait is set or it doesn't cover the current hour, which
+    refreshes it first. """
+    forecast = read_forecast(provider, zip_code, others)
+    stale = forecast.state.stale
+    if stale and (wait or not forecast.covers(datetime.now())):
+        refresh_stale(list(stale))
+        forecast = read_forecast(provider, zip_code, others)
+    return forecast
@@ -4,12 +4,15 @@ Description: Calendar widget for clock module
 Author: thnikk
 """
 import argparse
-import json
 from datetime import datetime
-import calendar
 import os
+import sys
 from widget import Widget
 import common as c
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+# pylint: disable=wrong-import-position
+from calendar_grid import MonthGrid
+import calendar_events
 
 
 def diff_month(year, month, diff):
@@ -25,19 +28,6 @@ def diff_month(year, month, diff):
     return year, month
 
 
-def cal_list(year, month, style=None):
-    """ Get calendar list for month and append style to boxes """
-    cal = calendar.Calendar(6)
-    return [
-        [
-            [day, [style]] for day in month
-            if day
-        ]
-        for month in
-        cal.monthdayscalendar(year, month)
-    ]
-
-
 def event_lookup(event):
     """ Get style for event """
     event_types = {
@@ -56,10 +46,13 @@ def parse_args() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     parser.add_argument('-o', '--output', type=str)
     parser.add_argument('-p', '--position', type=str, default='right')
+    parser.add_argument(
+        '-i', '--ics', action='append', default=[],
+        help='ICS file to import events from (can be used multiple times)')
     return parser.parse_args()
 
 
-def calendar_widget():
+def calendar_widget(ics):
     """ Draw calendar """
     widget = c.box('v', style='widget', spacing=20)
 
@@ -69,33 +62,25 @@ def calendar_widget():
     month_label = c.label(now.strftime('%B'), style='month-label')
     cal_section.add(month_label)
 
+    events = calendar_events.load(
+        os.path.expanduser('~/.config/calendar-events.json'), {
+            f"{now.month}/{now.day}":
+                "Set up events in ~/.config/calendar-events.json"
+        }, ics)
+
+    grid = MonthGrid(
+        now.year, now.month, events, firstweekday=6, context=2,
+        today=now.date())
+
     # Create calendar box
     row = c.box('h', spacing=10)
-    for dow in ["Su", "Mo", "Tu", "We", "Th", "Fr", "Sa"]:
+    for dow in grid.day_names():
         dow_label = c.label(dow, style='dow')
         row.add(dow_label)
     cal_box = c.box('v')
     cal_box.add(row)
 
-    last_month = cal_list(*diff_month(now.year, now.month, -1), 'old')[-2:]
-    current_month = cal_list(now.year, now.month)
-    next_month = cal_list(*diff_month(now.year, now.month, 1), 'old')[:2]
-
-    try:
-        with open(
-            os.path.expanduser('~/.config/calendar-events.json'),
-            'r', encoding='utf-8'
-        ) as file:
-            events = json.loads(file.read())
-    except FileNotFoundError:
-        events = {
-            f"{now.month}/{now.day}":
-                "Set up events in ~/.config/calendar-events.json"
-        }
-
-    style_events(last_month, current_month, next_month, events, now)
-
-    cal_box.add(draw_calendar(last_month, current_month, next_month))
+    cal_box.add(draw_calendar(grid))
     cal_section.add(cal_box)
     widget.add(cal_section)
 
@@ -104,44 +89,21 @@ def calendar_widget():
     return widget
 
 
-def style_events(last_month, current_month, next_month, events, now):
-    """ Add style to events """
-    for count, month in enumerate([last_month, current_month, next_month]):
-        for week in month:
-            for day, styles in week:
-                if count == 1 and day == now.day:
-                    styles.append('today')
-                date = (
-                    f"{diff_month(now.year, now.month, count - 1)[1]}"
-                    f"/{day}"
-                )
-                if date in list(events):
-                    event_style = event_lookup(events[date])
-                    styles.append('event')
-                    styles.append(event_style)
-
-
-def draw_calendar(last_month, current_month, next_month):
+def draw_calendar(grid):
     """ Draw calendar"""
-    combined_month = []
-    if len(last_month[-1]) < 7:
-        combined_month += last_month[:-1]
-        combined_month += [last_month[-1] + current_month[0]]
-        combined_month += current_month[1:]
-    else:
-        combined_month = last_month + current_month
-    if len(next_month[0]) < 7:
-        mixed_month = [combined_month[-1] + next_month[0]]
-        del combined_month[-1]
-        combined_month += mixed_month + next_month[1:]
     lines = c.box('v')
-    for week in combined_month:
+    for week in grid.weeks:
         line = c.box('h', spacing=10)
-        for day, styles in week:
-            day_label = c.label(day)
-            for style in styles:
-                if style:
-                    day_label.get_style_context().add_class(style)
+        for day in week:
+            day_label = c.label(day.date.day)
+            if day.outside:
+                day_label.get_style_context().add_class('old')
+            if day.today:
+                day_label.get_style_context().add_class('today')
+            if day.events:
+                day_label.get_style_context().add_class('event')
+                day_label.get_style_context().add_class(
+                    event_lookup(day.events[0]))
             day_label.get_style_context().add_class('day')
             line.add(day_label)
         lines.add(line)
@@ -152,11 +114,12 @@ def draw_events(now, events):
     """ Draw events """
     events_section = c.box('v', spacing=20)
     for offset, month in enumerate(['Last', 'This', 'Next']):
-        month_events = {
-            date: event for date, event in events.items()
-            if date.split('/', maxsplit=1)[0] == str(
-                diff_month(now.year, now.month, offset-1)[1])
-        }
+        year, month_number = diff_month(now.year, now.month, offset-1)
+        month_events = [
+            (f"{month_number}/{day}", event)
+            for day, day_events in events.month(year, month_number).items()
+            for event in day_events
+        ]
 
         if month_events:
             event_section = c.box('v', spacing=10)
@@ -165,7 +128,7 @@ def draw_events(now, events):
             event_section.add(event_line)
 
             events_box = c.box('v', style='events-box')
-            for date, event in month_events.items():
+            for count, (date, event) in enumerate(month_events):
                 event_box = c.box('h', style='event-box', spacing=10)
                 event_dot = c.label('', style='event-dot')
                 event_style = event_lookup(event)
@@ -177,7 +140,7 @@ def draw_events(now, events):
                     c.label(event, wrap=20), False, True, 0)
                 events_box.add(event_box)
 
-                if date != list(month_events)[-1]:
+                if count < len(month_events) - 1:
                     events_box.add(c.sep('h'))
             event_section.add(events_box)
             events_section.add(event_section)
@@ -190,7 +153,7 @@ def main():
     widget = Widget(args.output, args.position)
     css_path = "/".join(__file__.split('/')[:-1]) + '/style.css'
     widget.css(css_path)
-    widget.add(calendar_widget())
+    widget.add(calendar_widget(args.ics))
     widget.start()
 
 
@@ -3,94 +3,14 @@
 Description: Git widget
 Author: thnikk
 """
-import re
 import os
 import sys
 import argparse
-from datetime import datetime, timezone
-from subprocess import run, check_output, CalledProcessError
 from widget import Widget
 import common as c
-
-
-class Git:
-    """ Git class """
-    def __init__(self, path):
-        self.path = path
-        self.name = self.get_name()
-
-    def fetch(self) -> None:
-        """ Fetch """
-        try:
-            run(
-                ['git', '-C', self.path, 'fetch'],
-                check=True, capture_output=True
-            )
-        except CalledProcessError as e:
-            print(e.output)
-
-    def get_name(self) -> str:
-        """ Get name of repo """
-        name = check_output(
-            ['git', '-C', os.path.expanduser(self.path),
-             'config', '--get', 'remote.origin.url']
-        ).decode().strip().split('/')[-1].split('.')[0].replace('-', ' ')
-        return name.capitalize()
-
-    def commits(self):
-        """ Get commits """
-
-        def plural(num) -> str:
-            """ Pluralize word """
-            if num > 1:
-                return 's'
-            return ''
-
-        def get_time(input_list) -> str:
-            """ Get string of x days/minutes/hours ago """
-            for value, word in enumerate(['day', 'hour', 'minute', 'second']):
-                if input_list[value]:
-                    return (
-                        f"{input_list[value]} "
-                        f"{word}{plural(input_list[value])} ago")
-            return None
-
-        try:
-            command_output = run(
-                [
-                    'git', '-C', os.path.expanduser(self.path), 'log',
-                    '--name-only', 'main..origin'
-                ],
-                check=True, capture_output=True
-            ).stdout.decode('utf-8')
-        except CalledProcessError as e:
-            lines = e.stderr.decode('utf-8').splitlines()
-            for line in lines:
-                print(line)
-            sys.exit(1)
-        output = {}
-        for line in command_output.splitlines():
-            if re.match('^commit', line):
-                chash = line.split()[1][:7]
-                output[chash] = {
-                    "author": None, "date": None, "msg": None, "files": []}
-            elif re.match('^Author:', line):
-                output[chash]['author'] = \
-                    line.split(":")[1].split("<")[0].strip()
-            elif re.match('^Date:', line):
-                date = ':'.join(line.split(":")[1:]).strip()
-                delta = datetime.now(timezone.utc) - datetime.strptime(
-                    date, '%a %b %d %H:%M:%S %Y %z')
-                dhms = [
-                    delta.days, delta.seconds // 60 // 60,
-                    delta.seconds // 60, delta.seconds]
-                output[chash]['date'] = get_time(dhms)
-            elif re.match('^ ', line):
-                output[chash]['msg'] = line.strip().replace('&', 'and')
-            else:
-                if line:
-                    output[chash]['files'].append(line)
-        return output
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+# pylint: disable=wrong-import-position
+import git_cache
 
 
 def parse_args() -> argparse.ArgumentParser:
@@ -104,12 +24,17 @@ def parse_args() -> argparse.ArgumentParser:
 
 def git_widget(repo):
     """ Git widget """
-    git = Git(os.path.expanduser(repo))
-    commits = git.commits()
+    # Commits are cached by the git-updates module
+    try:
+        cache = git_cache.load(os.path.expanduser(repo))
+    except FileNotFoundError:
+        print(f"No cached commits for {repo}, run git-updates.py first.")
+        sys.exit(1)
+    commits = git_cache.commits(cache)
 
     main_box = c.box('v', style='widget', spacing=20)
     main_box.get_style_context().add_class('wide')
-    main_box.add(c.label(git.name, style='heading'))
+    main_box.add(c.label(cache['name'], style='heading'))
 
     commits_box = c.box('v', spacing=10)
     commits_box.add(c.label('Commits', style='title', ha='start'))